@@ -1,29 +1,45 @@
+import functools
+import hashlib
 import json
+import math
+import os
 import time
-from flask import Flask, jsonify, render_template, request
+import itertools
+import click
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, jsonify, render_template, request
 import requests
-from datetime import datetime
+from datetime import datetime, timezone
+from werkzeug.http import http_date
 import numpy as np
 from sklearn.ensemble import RandomForestRegressor
 
+import catalog
+import cluster
+import columnar
+import counts
+import formats
+import heatmap
+import report_index
+import reports
+import upstream
+from cache import RangeCache
+from upstream import SingleFlight
+
 
 app = Flask(__name__)
 
-# File to store reports
-FILE_PATH = "earthquake_reports.json"
+# Recent /earthquakes results, reused for narrower slider queries
+earthquake_cache = RangeCache()
+# Concurrent misses for the same query wait on a single load
+earthquake_loads = SingleFlight()
+# Background refreshes of stale cache entries
+refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="refresh")
+# Events serialized per chunk of a streamed /earthquakes response
+STREAM_BATCH = 500
+# Viewports of lower zoom levels are too large to fetch upstream on demand
+VIEWPORT_FETCH_ZOOM = 6
 
-def load_reports():
-    """Load existing earthquake reports from JSON file."""
-    try:
-        with open(FILE_PATH, "r") as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return []  # Return empty list if file doesn't exist
-
-def save_reports(reports):
-    """Save reports to JSON file."""
-    with open(FILE_PATH, "w") as file:
-        json.dump(reports, file, indent=4)
 '''
 def predict_magnitude(shaking,duration, objects, reaction, damage):
     # Load dataset (simulated), BUT LATER ON WE HAVE TO SWITCH TO READING TO earthquake_reports and magnitude of a certain no of earthquakes nearby
@@ -59,29 +75,43 @@ def estimate_magnitude(mmi):
     magnitude = 1.5 + 0.5 * mmi
     return round(magnitude, 1)
 
+def render_static(template_name):
+    """Render a template without context, answering revalidations with 304.
+
+    The body and its ETag are kept per template file modification time, so
+    an unchanged page is rendered and hashed once per process.
+    """
+    path = os.path.join(app.root_path, app.template_folder, template_name)
+    body, etag = _render_static(template_name, os.stat(path).st_mtime)
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+@functools.lru_cache(maxsize=16)
+def _render_static(template_name, mtime):
+    body = render_template(template_name)
+    return body, hashlib.sha1(body.encode()).hexdigest()
+
+
 @app.route('/')
 def home():
-    return render_template('map.html')
+    return render_static('map.html')
 
 def fetch_data_with_retry(url, max_retries=3, backoff_factor=2):
     retries = 0
-    headers = {'User-Agent': 'MyFlaskApp/1.0'}
-    
+
     while retries < max_retries:
         try:
-            response = requests.get(url, headers=headers)
+            response = upstream.get(url)
             print(f"Response Status Code: {response.status_code}")
             print(f"Response Content: {response.text}")
-            if response.status_code == 429:
-                retry_after = int(response.headers.get("Retry-After",2))  
-                print(f"Rate limited. Retrying after {retry_after} seconds...")
-                time.sleep(retry_after)
-                retries += 1
-                continue
-
             response.raise_for_status()
             return response.json()  
 
+        except (upstream.RateLimitedError, upstream.CircuitOpenError):
+            # Every caller is paused together; sleeping here would only hold the worker
+            raise
         except requests.exceptions.RequestException as e:
             print(f"Error: {e}")
             retries += 1
@@ -89,53 +119,484 @@ def fetch_data_with_retry(url, max_retries=3, backoff_factor=2):
 
     raise Exception("Max retries exceeded. Could not fetch data.")
 
-@app.route('/earthquakes', methods=['GET'])
-def get_earthquakes():
+def load_earthquakes(starttime, endtime, minmagnitude, region=catalog.BBOX, circle=None):
+    """Read a query from the catalog, filling gaps upstream, and cache it.
+
+    Returns (earthquakes, catalog version) with the version read before the
+    events, so a concurrent write can only make the version look older.
+    """
+    # Only ranges and regions the local catalog doesn't hold yet go upstream
+    catalog.fill_gaps(starttime, endtime, minmagnitude, region=region)
+    version = catalog.get_version()
+    earthquakes = catalog.query(starttime, endtime, minmagnitude, region, circle)
+    earthquake_cache.put(starttime, endtime, minmagnitude, earthquakes, version[0], area_key(region, circle))
+    return earthquakes, version
+
+
+def earthquakes_etag(version, *query):
+    """Strong ETag for a query's response at a given catalog version."""
+    return hashlib.sha1(repr((version[0],) + query).encode()).hexdigest()
+
+
+def conditional_headers(etag, version):
+    headers = {'ETag': f'"{etag}"'}
+    if version[1] is not None:
+        headers['Last-Modified'] = http_date(datetime.fromisoformat(version[1]).replace(tzinfo=timezone.utc))
+    return headers
+
+
+def is_not_modified(etag, version):
+    """True if the client's validators still match the current catalog."""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and version[1] is not None:
+        modified = datetime.fromisoformat(version[1]).replace(tzinfo=timezone.utc)
+        return modified <= request.if_modified_since
+    return False
+
+
+def magnitude_arg(value):
+    """Parse a magnitude parameter; ValueError unless it is a finite number."""
+    magnitude = float(value)
+    if not math.isfinite(magnitude):
+        raise ValueError(f"Invalid magnitude: {value}")
+    return magnitude
+
+
+def filter_args():
+    """Read the slider filters shared by the /earthquakes endpoints; ValueError if malformed."""
     startdate = request.args.get('startdate', '2024-01-01')
     enddate = request.args.get('enddate', '2025-12-31')
-    minmagnitude = float(request.args.get('minmagnitude', 3))
+    minmagnitude = magnitude_arg(request.args.get('minmagnitude', 3))
+    return catalog.normalize_time(startdate), catalog.normalize_time(enddate), minmagnitude
+
+
+def bbox_arg():
+    """Parse ?bbox=minlon,minlat,maxlon,maxlat; None when absent."""
+    bbox = request.args.get('bbox')
+    if not bbox:
+        return None
+    minlon, minlat, maxlon, maxlat = (float(value) for value in bbox.split(','))
+    return minlon, minlat, maxlon, maxlat
+
+
+def bbox_region(bbox):
+    minlon, minlat, maxlon, maxlat = bbox
+    return {'minlatitude': minlat, 'maxlatitude': maxlat, 'minlongitude': minlon, 'maxlongitude': maxlon}
+
+
+def area_args():
+    """Read the area of a query as (region, circle).
+
+    ?bbox=minlon,minlat,maxlon,maxlat selects a box; ?latitude=&longitude=
+    &radius= (km) a circle, with the region around it. Without either the
+    map's default region, catalog.BBOX, is used.
+    """
+    if 'radius' in request.args:
+        circle = (
+            float(request.args.get('latitude', '')),
+            float(request.args.get('longitude', '')),
+            float(request.args['radius']),
+        )
+        if not (-90 <= circle[0] <= 90 and -180 <= circle[1] <= 180 and circle[2] > 0):
+            raise ValueError(f"Invalid circle: {circle}")
+        return catalog.region_around(*circle), circle
+    bbox = bbox_arg()
+    if bbox is None:
+        return catalog.BBOX, None
+    minlon, minlat, maxlon, maxlat = bbox
+    if not (-180 <= minlon <= maxlon <= 180 and -90 <= minlat <= maxlat <= 90):
+        raise ValueError(f"Invalid bbox: {bbox}")
+    return bbox_region(bbox), None
+
+
+def area_key(region, circle):
+    """Hashable form of an area, for cache and coalescing keys."""
+    return tuple(sorted(region.items())), circle
+
+
+@app.route('/earthquakes', methods=['GET'])
+def get_earthquakes():
+    try:
+        starttime, endtime, minmagnitude = filter_args()
+        region, circle = area_args()
+    except ValueError:
+        return jsonify({'error': 'startdate and enddate must be ISO dates, minmagnitude a number; bbox must be minlon,minlat,maxlon,maxlat; radius (km) needs latitude and longitude.'}), 400
+    area = area_key(region, circle)
+    # json (default), ndjson, columnar or binary; see formats.py for the last two
+    output_format = request.args.get('format', 'json')
+    if output_format not in ('json', 'ndjson', 'columnar', 'binary'):
+        return jsonify({'error': f'Unknown format: {output_format}'}), 400
+    # ?format=ndjson or ?stream=1 send the events as they are serialized
+    streaming = output_format == 'ndjson' or (output_format == 'json' and request.args.get('stream') == '1')
+    query = (starttime, endtime, minmagnitude, area, output_format, streaming)
+    # Binary responses are packed straight from the sorted catalog columns
+    from_columns = output_format == 'binary'
+
+    # Parts of the window the catalog would have to fetch upstream first
+    gaps = catalog.missing_ranges(starttime, endtime, minmagnitude, region)
+
+    # A client holding the current version of a fully stored query gets a 304
+    # before anything is read or serialized
+    version = catalog.get_version()
+    etag = earthquakes_etag(version, *query)
+    if not gaps and is_not_modified(etag, version):
+        return Response(status=304, headers=conditional_headers(etag, version))
+
+    headers = {}
+    error = None
+
+    earthquakes = None if from_columns else earthquake_cache.get(starttime, endtime, minmagnitude, version[0], area)
+    if earthquakes is not None:
+        headers = conditional_headers(etag, version)
+    else:
+        # Reloading from the catalog alone is quick; only wait-on-upstream loads
+        # are worth answering from a stale entry
+        stale = earthquake_cache.get_stale(starttime, endtime, minmagnitude, area) if gaps and not from_columns else None
+        if stale is not None:
+            # Answer at once with the last good data and refresh it behind the scenes
+            earthquakes, age = stale
+            headers = {'Age': str(int(age)), 'Warning': '110 - "Response is Stale"'}
+            refresh_pool.submit(refresh_earthquakes, starttime, endtime, minmagnitude, region, circle)
+        else:
+            try:
+                if streaming or from_columns:
+                    # Streamed and binary results are read straight off the catalog rather than cached
+                    earthquake_loads.do(
+                        ('fill', starttime, endtime, minmagnitude, area[0]),
+                        catalog.fill_gaps, starttime, endtime, minmagnitude, region=region,
+                    )
+                    version = catalog.get_version()
+                    if from_columns:
+                        earthquakes = columnar.snapshot().select(starttime, endtime, minmagnitude, region, circle)
+                    else:
+                        earthquakes = catalog.iter_query(starttime, endtime, minmagnitude, region, circle)
+                else:
+                    earthquakes, version = earthquake_loads.do(
+                        (starttime, endtime, minmagnitude, area),
+                        load_earthquakes, starttime, endtime, minmagnitude, region, circle,
+                    )
+                headers = conditional_headers(earthquakes_etag(version, *query), version)
+            except requests.exceptions.RequestException as e:
+                print(f"Error fetching earthquake data: {e}")
+                # Upstream is down, rate limited or the circuit is open: fall back to what the catalog holds
+                error = e
+                if from_columns:
+                    earthquakes = columnar.snapshot().select(starttime, endtime, minmagnitude, region, circle)
+                else:
+                    earthquakes = catalog.iter_query(starttime, endtime, minmagnitude, region, circle)
+                    if not streaming:
+                        earthquakes = list(earthquakes)
+                headers = {'Warning': '111 - "Revalidation Failed"'}
+
+    if streaming:
+        earthquakes = iter(earthquakes)
+        first = next(earthquakes, None)
+        earthquakes = [] if first is None else itertools.chain([first], earthquakes)
+
+    if not earthquakes:
+        if isinstance(error, upstream.RateLimitedError):
+            return (
+                jsonify({'error': 'The seismic database is busy, please retry shortly.'}),
+                503,
+                {'Retry-After': str(int(error.retry_after) + 1)},
+            )
+        if error is not None:
+            return jsonify({'error': 'Failed to fetch data from the seismic database.'}), 500
+        return jsonify({'error': 'No earthquake data available for the specified filters.'}), 204
+
+    if streaming:
+        return stream_earthquakes(earthquakes, output_format), 200, headers
+
+    print(f"Filtered Earthquakes: {len(earthquakes)} returned.")
+    if output_format == 'columnar':
+        return jsonify(formats.encode_columnar(earthquakes)), 200, headers
+    if output_format == 'binary':
+        body = formats.pack_binary(
+            earthquakes.latitude, earthquakes.longitude, earthquakes.magnitude, earthquakes.depth, earthquakes.time,
+        )
+        return Response(body, mimetype=formats.BINARY_MIMETYPE), 200, headers
+    return jsonify(earthquakes), 200, headers
+
+
+def stream_earthquakes(earthquakes, output_format):
+    """Build a response that serializes events as the client reads them.
+
+    Events go out STREAM_BATCH at a time, as one JSON array or as NDJSON, so
+    the first bytes leave before the last event is serialized and no full
+    copy of the body is ever built.
+    """
+    def generate():
+        separator = '\n' if output_format == 'ndjson' else ','
+        if output_format != 'ndjson':
+            yield '['
+        first = True
+        for batch in iter(lambda: list(itertools.islice(earthquakes, STREAM_BATCH)), []):
+            chunk = separator.join(json.dumps(quake, separators=(',', ':')) for quake in batch)
+            if output_format == 'ndjson':
+                yield chunk + '\n'
+            else:
+                yield chunk if first else ',' + chunk
+            first = False
+        if output_format != 'ndjson':
+            yield ']'
+
+    mimetype = 'application/x-ndjson' if output_format == 'ndjson' else 'application/json'
+    return Response(generate(), mimetype=mimetype)
+
+
+def refresh_earthquakes(starttime, endtime, minmagnitude, region=catalog.BBOX, circle=None):
+    """Reload a stale cached query unless another refresh already did."""
+    version = catalog.get_version()
+    area = area_key(region, circle)
+    if earthquake_cache.get(starttime, endtime, minmagnitude, version[0], area) is not None:
+        return
+    try:
+        earthquake_loads.do(
+            (starttime, endtime, minmagnitude, area),
+            load_earthquakes, starttime, endtime, minmagnitude, region, circle,
+        )
+    except requests.exceptions.RequestException as e:
+        print(f"Background refresh failed: {e}")
+
 
-    # Construct the API URL
-    url = (
-        f"https://www.seismicportal.eu/fdsnws/event/1/query?"
-        f"format=json&minlatitude=39.5&maxlatitude=42.7&"
-        f"minlongitude=19.2&maxlongitude=21.1&"
-        f"starttime={startdate}&endtime={enddate}&minmagnitude={minmagnitude}"
-    )
+@app.route('/earthquakes/grid', methods=['GET'])
+def get_earthquake_grid():
+    """Magnitude-weighted density cells for a zoom level and viewport.
 
+    Returns {"z", "cell", "cells": [[lat, lon, weight, count], ...]} with
+    cell centres, read from the precomputed pyramid in heatmap.py.
+    """
     try:
-        response = requests.get(url)
-        print(f"Response Status Code: {response.status_code}")
-
-        # Check for no content (204)
-        if response.status_code == 204:
-            return jsonify({'error': 'No earthquake data available for the specified filters.'}), 204
-
-        response.raise_for_status()  # Raise exception for HTTP errors
-        data = response.json()  # Parse JSON
-
-        # Extract relevant earthquake data
-        earthquakes = [
-            {
-                'latitude': feature['geometry']['coordinates'][1],
-                'longitude': feature['geometry']['coordinates'][0],
-                'magnitude': feature['properties']['mag'],
-                'timestamp': feature['properties']['time'],
-                'depth': feature['properties']['depth']
-            }
-            for feature in data.get('features', [])
-        ]
-
-        print(f"Filtered Earthquakes: {len(earthquakes)} returned.")
-        return jsonify(earthquakes)
+        starttime, endtime, minmagnitude = filter_args()
+        z = int(request.args.get('z', 7))
+        bbox = bbox_arg()
+    except ValueError:
+        return jsonify({'error': 'startdate and enddate must be ISO dates, minmagnitude a number, z an integer and bbox minlon,minlat,maxlon,maxlat.'}), 400
 
+    try:
+        catalog.fill_gaps(starttime, endtime, minmagnitude)
     except requests.exceptions.RequestException as e:
+        # The grid is drawn from whatever the catalog already holds
         print(f"Error fetching earthquake data: {e}")
-        return jsonify({'error': 'Failed to fetch data from the seismic database.'}), 500
+
+    version = catalog.get_version()
+    etag = earthquakes_etag(version, starttime, endtime, minmagnitude, 'grid', z, bbox)
+    if is_not_modified(etag, version):
+        return Response(status=304, headers=conditional_headers(etag, version))
+
+    level = heatmap.get_pyramid(starttime, endtime, minmagnitude).level(z)
+    body = {'z': level.z, 'cell': level.size, 'cells': level.cells(bbox)}
+    return jsonify(body), 200, conditional_headers(etag, version)
+
+
+@app.route('/earthquakes/clusters', methods=['GET'])
+def get_earthquake_clusters():
+    """Marker clusters for a zoom level and viewport.
+
+    Returns {"z", "version", "clusters": [[lat, lon, count, max_magnitude],
+    ...], "events": [...]}; past cluster.MAX_CLUSTER_ZOOM clusters is empty
+    and events holds the individual events, as /earthquakes returns them.
+    version is the catalog version they were read at.
+    """
+    try:
+        starttime, endtime, minmagnitude = filter_args()
+        z = int(request.args.get('z', 7))
+        bbox = bbox_arg()
+    except ValueError:
+        return jsonify({'error': 'startdate and enddate must be ISO dates, minmagnitude a number, z an integer and bbox minlon,minlat,maxlon,maxlat.'}), 400
+
+    # The viewport itself is fetched once it is small enough to be worth it
+    region = catalog.BBOX if bbox is None or z < VIEWPORT_FETCH_ZOOM else bbox_region(bbox)
+    try:
+        catalog.fill_gaps(starttime, endtime, minmagnitude, region=region)
+    except requests.exceptions.RequestException as e:
+        # Clusters are built from whatever the catalog already holds
+        print(f"Error fetching earthquake data: {e}")
+
+    version = catalog.get_version()
+    etag = earthquakes_etag(version, starttime, endtime, minmagnitude, 'clusters', z, bbox)
+    if is_not_modified(etag, version):
+        return Response(status=304, headers=conditional_headers(etag, version))
+
+    index = cluster.get_index(starttime, endtime, minmagnitude)
+    if z > cluster.MAX_CLUSTER_ZOOM:
+        body = {'z': z, 'version': index.version, 'clusters': [], 'events': index.events_in(bbox)}
+    else:
+        body = {'z': z, 'version': index.version, 'clusters': index.clusters(z, bbox), 'events': []}
+    return jsonify(body), 200, conditional_headers(etag, version)
+
+
+@app.route('/earthquakes/diff', methods=['GET'])
+def get_earthquake_diff():
+    """Events to remove and add to go from one filter state to another.
+
+    The new state takes the /earthquakes parameters, area included; the
+    previous one prevstartdate, prevenddate and prevminmagnitude over the
+    same area. ?since= is the catalog version the previous result was read
+    at; events revised after it come back in "added" again. Returns
+    {"version", "removed": [ids], "added": [events]}.
+    """
+    try:
+        starttime, endtime, minmagnitude = filter_args()
+        previous = (
+            catalog.normalize_time(request.args['prevstartdate']),
+            catalog.normalize_time(request.args['prevenddate']),
+            magnitude_arg(request.args['prevminmagnitude']),
+        )
+        since = int(request.args['since']) if 'since' in request.args else None
+        region, circle = area_args()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'startdate, enddate and the required prevstartdate, prevenddate must be ISO dates, minmagnitude and prevminmagnitude numbers, since an integer.'}), 400
+    area = area_key(region, circle)
+
+    headers = {}
+    try:
+        earthquake_loads.do(
+            ('fill', starttime, endtime, minmagnitude, area[0]),
+            catalog.fill_gaps, starttime, endtime, minmagnitude, region=region,
+        )
+    except requests.exceptions.RequestException as e:
+        # The diff is taken against whatever the catalog already holds
+        print(f"Error fetching earthquake data: {e}")
+        headers = {'Warning': '111 - "Revalidation Failed"'}
+
+    version = catalog.get_version()
+    etag = earthquakes_etag(version, 'diff', previous, starttime, endtime, minmagnitude, area, since)
+    if not headers and is_not_modified(etag, version):
+        return Response(status=304, headers=conditional_headers(etag, version))
+
+    removed, added = catalog.diff(previous, (starttime, endtime, minmagnitude), region, circle, since)
+    body = {'version': version[0], 'removed': removed, 'added': added}
+    return jsonify(body), 200, headers or conditional_headers(etag, version)
+
+
+@app.route('/earthquakes/counts', methods=['GET'])
+def get_earthquake_counts():
+    """Number of stored events per slider position, from the cube in counts.py.
+
+    ?startyear=&endyear=&minmagnitude= returns {"count", "complete"}, where
+    complete is false while part of the window still has to be fetched.
+    Without startyear the whole cumulative cube is returned, for the page
+    to look counts up itself while a slider is dragged.
+    """
+    version = catalog.get_version()
+    query = tuple(request.args.get(name) for name in ('startyear', 'endyear', 'minmagnitude'))
+    etag = earthquakes_etag(version, 'counts', *query)
+    if is_not_modified(etag, version):
+        return Response(status=304, headers=conditional_headers(etag, version))
+
+    cube = counts.get_cube()
+    if query[0] is None:
+        return jsonify(cube.to_dict()), 200, conditional_headers(etag, version)
+    try:
+        start_year = int(query[0])
+        end_year = int(query[1] or cube.last_year)
+        minmagnitude = magnitude_arg(query[2] or 0)
+        if not (1 <= start_year <= 9999 and 1 <= end_year <= 9999):
+            raise ValueError(f"Invalid years: {start_year}, {end_year}")
+    except ValueError:
+        return jsonify({'error': 'startyear and endyear must be years from 1 to 9999, minmagnitude a finite number.'}), 400
+    gaps = catalog.missing_ranges(f"{start_year:04d}-01-01T00:00:00", f"{end_year:04d}-12-31T23:59:59", minmagnitude)
+    body = {'count': cube.count(start_year, end_year, minmagnitude), 'complete': not gaps}
+    return jsonify(body), 200, conditional_headers(etag, version)
+
+
+@app.route('/tiles/heat/<int:z>/<int:x>/<int:y>.png', methods=['GET'])
+def get_heat_tile(z, x, y):
+    """Heatmap raster tile for the slider filters, drawn from the stored catalog.
+
+    Tiles don't fill catalog gaps themselves; the /earthquakes request the
+    map makes for the same filters does that.
+    """
+    if not heatmap.is_valid_tile(z, x, y):
+        return jsonify({'error': f'z must be 0-{heatmap.MAX_TILE_ZOOM}, x and y 0 to 2**z - 1.'}), 400
+    try:
+        starttime, endtime, minmagnitude = filter_args()
+    except ValueError:
+        return jsonify({'error': 'startdate and enddate must be ISO dates, minmagnitude a number.'}), 400
+    version = catalog.get_version()
+    etag = earthquakes_etag(version, starttime, endtime, minmagnitude, 'tile', z, x, y)
+    if is_not_modified(etag, version):
+        return Response(status=304, headers=conditional_headers(etag, version))
+
+    tile, _ = heatmap.get_tile(starttime, endtime, minmagnitude, z, x, y)
+    return Response(tile, mimetype='image/png', headers=conditional_headers(etag, version))
+
+
+@app.route('/earthquakes/cache', methods=['GET'])
+def earthquake_cache_stats():
+    return jsonify(dict(
+        earthquake_cache.stats(),
+        coalesced=earthquake_loads.shared,
+        circuit_open=upstream.breaker.is_open,
+    ))
+
+
+@app.cli.command('sync-catalog')
+@click.option('--start-year', default=int(catalog.BACKFILL_START[:4]), show_default=True)
+@click.option('--end-year', default=int(catalog.BACKFILL_END[:4]), show_default=True)
+def sync_catalog(start_year, end_year):
+    """Backfill the local earthquake catalog from the FDSN service."""
+    catalog.backfill(start_year, end_year)
+    # Workers started afterwards map the columns instead of reading the store
+    columnar.save(columnar.snapshot())
+
+
+@app.cli.command('sync-updates')
+def sync_updates():
+    """Fetch catalog events created or updated since the last sync."""
+    catalog.sync_updates()
+    columnar.save(columnar.snapshot())
+
+@app.cli.command('sync-daemon')
+@click.option('--interval', default=catalog.SYNC_INTERVAL, show_default=True, help="Seconds between two syncs.")
+def sync_daemon(interval):
+    """Keep the catalog and its snapshot up to date, in the foreground.
+
+    Run exactly one of these next to the web workers (e.g. gunicorn), which
+    never sync or save: it fetches updates every --interval seconds and saves
+    the column snapshot the workers map. A second one exits, as it can't get
+    the sync lock.
+    """
+    lock = catalog.acquire_sync_lock()
+    if lock is None:
+        raise click.ClickException(f"Another process is syncing the catalog ({catalog.SYNC_LOCK_PATH} is locked).")
+    columnar.start_save_thread()
+    catalog.run_sync_loop(interval)
+
+
+@app.cli.command('compact-reports')
+def compact_reports():
+    """Rewrite the report log without superseded or unreadable records."""
+    reports.compact()
+
+
+@app.route('/reports/summary', methods=['GET'])
+def get_report_summary():
+    """Felt reports aggregated over a submission window and area.
+
+    ?startdate=&enddate= bound the submission time, both optional. ?bbox=
+    or ?radius= narrow the area as for /earthquakes; without them reports
+    from anywhere count, including those without a location. The reports
+    come from report_index, which only reads what was stored since the
+    previous request.
+    """
+    try:
+        region, circle = area_args() if request.args.get('bbox') or 'radius' in request.args else (None, None)
+        starttime, endtime = (
+            catalog.normalize_time(request.args[name]) if request.args.get(name) else None
+            for name in ('startdate', 'enddate')
+        )
+    except ValueError:
+        return jsonify({'error': 'startdate and enddate must be ISO dates; bbox or radius as for /earthquakes.'}), 400
+    columns = report_index.snapshot()
+    return jsonify(columns.summary(columns.mask(starttime, endtime, region, circle)))
+
 
 @app.route('/report_earthquake')
 def report_earthquake():
-    return render_template('report_earthquake.html')
+    return render_static('report_earthquake.html')
 
 
 @app.route('/submit_report', methods=['POST'])
@@ -153,12 +614,9 @@ def submit_report():
         # Compute MMI and Magnitude
         mmi = calculate_mmi(shaking, duration, objects, reactions, damage)
         predicted_magnitude = estimate_magnitude(mmi)
-        # Load existing reports
-        reports = load_reports()
 
-        # Add new report
+        # Add new report; the store assigns its id
         new_report = {
-            "id": len(reports) + 1,
             "location": location,
             "shaking": shaking,
             "duration": duration,
@@ -168,18 +626,33 @@ def submit_report():
             "predicted_magnitude": predicted_magnitude,
             "submission_time": submission_time
         }
-        reports.append(new_report)
-
-        # Save back to JSON file
-        save_reports(reports)
+        # Written in the background within reports.FLUSH_INTERVAL
+        reports.submit_report(new_report)
 
         # Return response
-        return render_template('submit_report.html', predicted_magnitude=predicted_magnitude)
+        return render_template('submit_report.html', mmi=mmi, predicted_magnitude=predicted_magnitude)
 
+    except reports.QueueFullError as e:
+        print(f"Error: {e}")
+        return (
+            jsonify({'error': 'Too many reports are being submitted, please retry shortly.'}),
+            503,
+            {'Retry-After': str(int(e.retry_after) + 1)},
+        )
 
     except Exception as e:
         print(f"Error: {e}")
         return jsonify({"error": "Failed to submit the report."}), 500
 
 if __name__ == '__main__':
+    # The development server is a single process, so it syncs and saves
+    # itself (only in the reloader child, which serves the requests), unless
+    # a `flask sync-daemon` already does. Deployed workers never do; see
+    # sync_daemon().
+    sync_lock = None
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        sync_lock = catalog.acquire_sync_lock()
+    if sync_lock is not None:
+        catalog.start_sync_thread()
+        columnar.start_save_thread()
     app.run(debug=True)
\ No newline at end of file
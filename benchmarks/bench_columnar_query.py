@@ -0,0 +1,82 @@
+"""Query latency against catalog size: list of dicts vs sorted NumPy columns.
+
+Each query is a one-year window with minmagnitude 3, on a synthetic catalog
+spread over 1900-2025. The dict baseline is skipped above DICT_LIMIT events,
+where the list alone would take several GiB.
+
+Run from the repository root:
+
+    python benchmarks/bench_columnar_query.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from columnar import Columns  # noqa: E402
+
+EVENT_COUNTS = [10_000, 100_000, 1_000_000, 10_000_000]
+DICT_LIMIT = 1_000_000
+REPEAT = 20
+
+WINDOW = ('2020-01-01T00:00:00', '2020-12-31T23:59:59')
+MINMAGNITUDE = 3.0
+
+
+def synthetic_columns(count):
+    rng = np.random.default_rng(0)
+    start, end = np.datetime64('1900-01-01', 'ms').astype(np.int64), np.datetime64('2025-12-31', 'ms').astype(np.int64)
+    return Columns(
+        0,
+        np.sort(rng.integers(start, end, count)),
+        rng.uniform(39.5, 42.7, count).astype(np.float32),
+        rng.uniform(19.2, 21.1, count).astype(np.float32),
+        rng.uniform(0.5, 6.5, count).round(1).astype(np.float32),
+        rng.uniform(1, 30, count).astype(np.float32),
+    )
+
+
+def as_dicts(columns):
+    timestamps = np.datetime_as_string(columns.time.astype('datetime64[ms]'), unit='s')
+    return [
+        {'latitude': lat, 'longitude': lon, 'magnitude': mag, 'timestamp': t, 'depth': depth}
+        for lat, lon, mag, t, depth in zip(
+            columns.latitude.tolist(), columns.longitude.tolist(), columns.magnitude.tolist(),
+            timestamps.tolist(), columns.depth.tolist(),
+        )
+    ]
+
+
+def filter_dicts(events):
+    starttime, endtime = WINDOW
+    return [
+        event for event in events
+        if starttime <= event['timestamp'] <= endtime and event['magnitude'] >= MINMAGNITUDE
+    ]
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    for _ in range(REPEAT):
+        result = fn(*args)
+    return (time.perf_counter() - started) / REPEAT * 1000, len(result)
+
+
+def main():
+    print(f"{'events':>10} | {'dicts ms':>9} | {'columns ms':>10} | {'matches':>8}")
+    for count in EVENT_COUNTS:
+        columns = synthetic_columns(count)
+        columns_ms, matches = timed(columns.select, *WINDOW, MINMAGNITUDE)
+        dicts_ms = '-'
+        if count <= DICT_LIMIT:
+            elapsed, dict_matches = timed(filter_dicts, as_dicts(columns))
+            assert dict_matches == matches
+            dicts_ms = f'{elapsed:.2f}'
+        print(f"{count:>10} | {dicts_ms:>9} | {columns_ms:>10.3f} | {matches:>8}")
+
+
+if __name__ == '__main__':
+    main()
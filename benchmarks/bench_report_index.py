@@ -0,0 +1,69 @@
+"""Cost of reading the reports after new submissions, against the log size.
+
+Compares parsing the whole log (load_reports) with refreshing the
+in-memory columns of report_index, which reads only the records appended
+since its previous refresh.
+
+Run from the repository root:
+
+    python benchmarks/bench_report_index.py
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import report_index  # noqa: E402
+import reports  # noqa: E402
+
+REPORT_COUNTS = [10_000, 100_000, 1_000_000]
+NEW_REPORTS = 100
+ROUNDS = 5
+
+
+def report(i):
+    return {
+        'id': i + 1,
+        'location': '41.3275, 19.8187',
+        'shaking': 3,
+        'duration': 2,
+        'objects': 3,
+        'reactions': 2,
+        'damage': 1,
+        'predicted_magnitude': 2.9,
+        'submission_time': '2025-02-13T22:45:26.883398Z',
+    }
+
+
+def main():
+    new_report = {key: value for key, value in report(0).items() if key != 'id'}
+    print(f"{'reports':>9} | {'full parse ms':>13} | {f'refresh +{NEW_REPORTS} ms':>15}")
+    with tempfile.TemporaryDirectory() as directory:
+        for count in REPORT_COUNTS:
+            store = reports.JsonReportStore(
+                os.path.join(directory, f'reports-{count}.jsonl'), os.path.join(directory, 'missing.json')
+            )
+            with open(store.path, 'w') as file:
+                file.writelines(json.dumps(report(i)) + '\n' for i in range(count))
+            reports.store = store
+            report_index._cursor = None
+            report_index.snapshot()
+
+            full = refresh = 0
+            for _ in range(ROUNDS):
+                store.append_many([new_report] * NEW_REPORTS)
+                started = time.perf_counter()
+                report_index.snapshot()
+                refresh += time.perf_counter() - started
+                started = time.perf_counter()
+                store.load()
+                full += time.perf_counter() - started
+            os.unlink(store.path)
+            print(f"{count:>9} | {full / ROUNDS * 1000:>13.1f} | {refresh / ROUNDS * 1000:>15.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Latency of one report submission against the number of stored reports.
+
+Compares the old write path (parse the whole JSON array, append, rewrite it
+with indent=4) with the stores in reports.py: the append-only log (one
+fsynced line) and SQLite (one insert).
+The old path runs fewer rounds at large sizes, where one round takes seconds.
+
+Run from the repository root:
+
+    python benchmarks/bench_report_submit.py
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import reports  # noqa: E402
+
+REPORT_COUNTS = [1_000, 100_000, 1_000_000]
+LOG_ROUNDS = 50
+
+
+def report(i):
+    return {
+        'id': i + 1,
+        'location': '41.3275, 19.8187',
+        'shaking': 3,
+        'duration': 2,
+        'objects': 3,
+        'reactions': 2,
+        'damage': 1,
+        'predicted_magnitude': 2.9,
+        'submission_time': '2025-02-13T22:45:26.883398Z',
+    }
+
+
+def submit_rewrite(path, new_report):
+    # What submit_report used to do
+    with open(path, 'r') as file:
+        stored = json.load(file)
+    stored.append(dict(new_report, id=len(stored) + 1))
+    with open(path, 'w') as file:
+        json.dump(stored, file, indent=4)
+
+
+def timed(fn, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+def main():
+    new_report = {key: value for key, value in report(0).items() if key != 'id'}
+    print(f"{'reports':>9} | {'rewrite ms':>11} | {'append ms':>9} | {'sqlite ms':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for count in REPORT_COUNTS:
+            legacy = os.path.join(directory, f'reports-{count}.json')
+            with open(legacy, 'w') as file:
+                json.dump([report(i) for i in range(count)], file, indent=4)
+            rewrite_ms = timed(lambda: submit_rewrite(legacy, new_report), 5 if count < 1_000_000 else 1)
+            os.unlink(legacy)
+
+            log = reports.JsonReportStore(
+                os.path.join(directory, f'reports-{count}.jsonl'), os.path.join(directory, 'missing.json')
+            )
+            with open(log.path, 'w') as file:
+                file.writelines(json.dumps(report(i)) + '\n' for i in range(count))
+            append_ms = timed(lambda: log.append(new_report), LOG_ROUNDS)
+
+            # Imports the log on creation
+            db = reports.SqliteReportStore(os.path.join(directory, f'reports-{count}.db'), import_from=log)
+            sqlite_ms = timed(lambda: db.append(new_report), LOG_ROUNDS)
+            os.unlink(log.path)
+
+            print(f"{count:>9} | {rewrite_ms:>11.2f} | {append_ms:>9.3f} | {sqlite_ms:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Peak memory of parsing an FDSN response: whole document vs streaming.
+
+Run from the repository root:
+
+    python benchmarks/bench_stream_parse.py
+
+It first checks that streaming parses a document split at every byte
+offset the same as json.loads().
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jsonstream  # noqa: E402
+from catalog import event_row  # noqa: E402
+
+EVENT_COUNTS = [1_000, 10_000, 100_000]
+
+
+def feature(i):
+    return {
+        'type': 'Feature',
+        'id': f'20240101_{i:07d}',
+        'geometry': {'type': 'Point', 'coordinates': [19.2 + (i % 190) / 100, 39.5 + (i % 320) / 100, -10.0]},
+        'properties': {
+            'source_id': str(i), 'source_catalog': 'EMSC-RTS', 'lastupdate': '2024-01-02T00:00:00.0Z',
+            'time': '2024-01-01T00:00:00.0Z', 'flynn_region': 'ALBANIA', 'lat': 41.0, 'lon': 20.0,
+            'depth': 10.0, 'evtype': 'ke', 'auth': 'EMSC', 'mag': 3.1, 'magtype': 'ml', 'unid': f'20240101_{i:07d}',
+        },
+    }
+
+
+def document_chunks(count, chunk_size=64 * 1024):
+    """Yield a FeatureCollection of `count` events as bytes, like a streamed body."""
+    pending = [b'{"type": "FeatureCollection", "metadata": {"count": %d}, "features": [' % count]
+    size = len(pending[0])
+    for i in range(count):
+        piece = (b',' if i else b'') + json.dumps(feature(i)).encode()
+        pending.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b''.join(pending)
+            pending, size = [], 0
+    pending.append(b']}')
+    yield b''.join(pending)
+
+
+def parse_whole(count):
+    # What get_earthquakes used to do: body in memory, response.json(), then a list of dicts
+    body = b''.join(document_chunks(count))
+    data = json.loads(body)
+    events = [
+        {
+            'latitude': f['geometry']['coordinates'][1],
+            'longitude': f['geometry']['coordinates'][0],
+            'magnitude': f['properties']['mag'],
+            'timestamp': f['properties']['time'],
+            'depth': f['properties']['depth'],
+        }
+        for f in data.get('features', [])
+    ]
+    return len(events)
+
+
+def parse_streaming(count):
+    # What the catalog does now: rows are handed on as they are parsed
+    return sum(1 for _ in map(event_row, jsonstream.iter_array(document_chunks(count), 'features')))
+
+
+def check_split_anywhere(count=3):
+    """Parse small documents cut in two at every offset.
+
+    Numbers stand at the top level and in the array too, where a cut after
+    their '.', 'e' or sign leaves a shorter number that still decodes.
+    """
+    features = b''.join(document_chunks(count)).replace(b'{"type"', b'{"took": 12.5e-3, "type"', 1)
+    documents = [(features, 'features'), (b'{"values": [1.5, -2E+3, 30], "z": 10.25}', 'values')]
+    for body, key in documents:
+        expected = json.loads(body)[key]
+        for cut in range(len(body) + 1):
+            parsed = list(jsonstream.iter_array([body[:cut], body[cut:]], key))
+            assert parsed == expected, f"Parsed differently when split at offset {cut}: {body[:cut][-20:]!r}"
+
+
+def measure(fn, count):
+    tracemalloc.start()
+    started = time.perf_counter()
+    parsed = fn(count)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert parsed == count
+    return peak / 2**20, elapsed
+
+
+def main():
+    check_split_anywhere()
+    print(f"{'events':>8} | {'whole MiB':>10} {'s':>6} | {'stream MiB':>10} {'s':>6}")
+    for count in EVENT_COUNTS:
+        whole_peak, whole_time = measure(parse_whole, count)
+        stream_peak, stream_time = measure(parse_streaming, count)
+        print(f"{count:>8} | {whole_peak:>10.1f} {whole_time:>6.2f} | {stream_peak:>10.1f} {stream_time:>6.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Concurrent report submissions: no lost or duplicate ids, and throughput.
+
+Runs SUBMITTERS threads in each of PROCESSES processes against one store.
+Every process writes through its own Committer, as app workers do. It then
+checks that the store holds exactly the submitted reports with ids 1..N in
+order. Throughput is compared with every thread writing to the store
+directly (one write and fsync per report).
+
+Run from the repository root:
+
+    python benchmarks/stress_report_submit.py
+"""
+import functools
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import reports  # noqa: E402
+
+SUBMITTERS = [1, 4, 16, 64]
+PROCESSES = 4
+REPORTS_PER_PROCESS = 2_000
+
+
+def report(process, i):
+    return {
+        # Unique per submission, to find lost or duplicated reports
+        'location': f'{process}.0, {i}',
+        'shaking': 3,
+        'duration': 2,
+        'objects': 3,
+        'reactions': 2,
+        'damage': 1,
+        'predicted_magnitude': 2.9,
+        'submission_time': '2025-02-13T22:45:26.883398Z',
+    }
+
+
+def open_store(backend, directory):
+    if backend == 'json':
+        return reports.JsonReportStore(os.path.join(directory, 'reports.jsonl'), os.path.join(directory, 'missing.json'))
+    return reports.SqliteReportStore(os.path.join(directory, 'reports.db'))
+
+
+def submit_all(backend, directory, process, threads, grouped):
+    store = open_store(backend, directory)
+    append = functools.partial(reports.Committer(store).submit, wait=True) if grouped else store.append
+    per_thread = REPORTS_PER_PROCESS // threads
+
+    def run(thread):
+        for i in range(per_thread):
+            result = append(report(process, thread * per_thread + i))
+            # Like a request, a submitter waits until its report is stored
+            if grouped:
+                result.result()
+
+    workers = [threading.Thread(target=run, args=(thread,)) for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def check(backend, directory, threads):
+    stored = open_store(backend, directory).load()
+    per_thread = REPORTS_PER_PROCESS // threads
+    expected = {report(process, i)['location'] for process in range(PROCESSES) for i in range(per_thread * threads)}
+    ids = [stored_report['id'] for stored_report in stored]
+    locations = [stored_report['location'] for stored_report in stored]
+    assert ids == list(range(1, len(expected) + 1)), 'ids are not 1..N in order'
+    assert len(set(locations)) == len(locations), 'a report was stored twice'
+    assert set(locations) == expected, 'a report was lost'
+    return len(stored)
+
+
+def run(backend, threads, grouped):
+    with tempfile.TemporaryDirectory() as directory:
+        open_store(backend, directory)
+        processes = [
+            multiprocessing.Process(target=submit_all, args=(backend, directory, process, threads, grouped))
+            for process in range(PROCESSES)
+        ]
+        started = time.perf_counter()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0, f'submitter exited with {process.exitcode}'
+        elapsed = time.perf_counter() - started
+        return check(backend, directory, threads) / elapsed
+
+
+def main():
+    for backend in ('json', 'sqlite'):
+        print(f"{backend}: {PROCESSES} processes x {REPORTS_PER_PROCESS} reports")
+        print(f"{'threads':>9} | {'direct/s':>9} | {'grouped/s':>9}")
+        for threads in SUBMITTERS:
+            direct = run(backend, threads, grouped=False)
+            grouped = run(backend, threads, grouped=True)
+            print(f"{threads:>9} | {direct:>9.0f} | {grouped:>9.0f}")
+    print("No lost or duplicate reports.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""In-memory cache of /earthquakes results that understands query ranges.
+
+A query for (startdate, enddate, minmagnitude) is answered from any cached
+result for the same area whose window contains it and whose minmagnitude
+is not higher, by filtering that result instead of asking the catalog again.
+
+Entries are fresh for `ttl` seconds, and only while the catalog is still
+at the version they were read from. They may then be served as stale for
+`stale_ttl` more seconds while they are refreshed in the background.
+"""
+import bisect
+import threading
+import time
+from collections import OrderedDict
+
+
+class RangeCache:
+    def __init__(self, max_entries=128, max_events=500_000, ttl=300, stale_ttl=3600):
+        self.max_entries = max_entries
+        self.max_events = max_events
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = OrderedDict()  # (start, end, magnitude, area) -> (stored_at, version, times, events)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.subsumed_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, starttime, endtime, minmagnitude, version=None, area=None):
+        """Return the events for the query from a fresh entry, or None on a miss.
+
+        Times must be normalized strings so they compare with the event
+        timestamps; cached event lists are kept sorted by timestamp. When a
+        catalog version is given, entries read at another version are stale.
+        area is any hashable description of the region the events are from.
+        """
+        found = self._lookup(starttime, endtime, minmagnitude, self.ttl, version, area)
+        with self._lock:
+            if found is None:
+                self.misses += 1
+                return None
+            if found[2]:
+                self.hits += 1
+            else:
+                self.subsumed_hits += 1
+        return found[0]
+
+    def get_stale(self, starttime, endtime, minmagnitude, area=None):
+        """Return (events, age in seconds) from an entry within its stale window."""
+        found = self._lookup(starttime, endtime, minmagnitude, self.ttl + self.stale_ttl, area=area)
+        if found is None:
+            return None
+        with self._lock:
+            self.stale_hits += 1
+        return found[0], found[1]
+
+    def _lookup(self, starttime, endtime, minmagnitude, max_age, version=None, area=None):
+        """Find (events, age, exact) for the query among entries younger than
+        max_age (and read at `version`, if given)."""
+        key = (starttime, endtime, minmagnitude, area)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < max_age and version in (None, entry[1]):
+                self._entries.move_to_end(key)
+                return entry[3], now - entry[0], True
+
+            best_key = None
+            for cached_key, (stored_at, entry_version, times, events) in list(self._entries.items()):
+                if now - stored_at >= self.ttl + self.stale_ttl:
+                    self._evict(cached_key)
+                    continue
+                if now - stored_at >= max_age or version not in (None, entry_version):
+                    continue
+                cached_start, cached_end, cached_magnitude, cached_area = cached_key
+                if cached_area != area:
+                    continue
+                if cached_start <= starttime and cached_end >= endtime and cached_magnitude <= minmagnitude:
+                    if best_key is None or len(events) < len(self._entries[best_key][3]):
+                        best_key = cached_key
+
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            stored_at, _, times, events = self._entries[best_key]
+
+        lo = bisect.bisect_left(times, starttime)
+        hi = bisect.bisect_right(times, endtime)
+        filtered = [event for event in events[lo:hi] if event['magnitude'] >= minmagnitude]
+        return filtered, now - stored_at, False
+
+    def put(self, starttime, endtime, minmagnitude, events, version=None, area=None):
+        if len(events) > self.max_events:
+            return
+        key = (starttime, endtime, minmagnitude, area)
+        times = [event['timestamp'] for event in events]
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            self._entries[key] = (time.monotonic(), version, times, events)
+            self._size += len(events)
+            while len(self._entries) > self.max_entries or self._size > self.max_events:
+                self._evict(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'events': self._size,
+                'hits': self.hits,
+                'subsumed_hits': self.subsumed_hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+            }
+
+    def _evict(self, key):
+        events = self._entries.pop(key)[3]
+        self._size -= len(events)
@@ -0,0 +1,676 @@
+"""Local earthquake catalog stored in SQLite.
+
+/earthquakes answers its date, magnitude and area filters from this store.
+The FDSN service is only asked for the time ranges and regions the catalog
+does not cover yet. A region is a dict with the keys of BBOX, the default.
+"""
+import fcntl
+import math
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from itertools import islice
+
+import numpy as np
+import requests
+
+import jsonstream
+import upstream
+
+# File holding the local catalog
+CATALOG_PATH = "earthquake_catalog.db"
+
+# Locked by the one process that runs the background sync
+SYNC_LOCK_PATH = "earthquake_catalog.sync.lock"
+
+FDSN_URL = "https://www.seismicportal.eu/fdsnws/event/1/query"
+
+# Region served by the map (Albania)
+BBOX = {
+    "minlatitude": 39.5,
+    "maxlatitude": 42.7,
+    "minlongitude": 19.2,
+    "maxlongitude": 21.1,
+}
+
+# Regions fetched upstream are widened to this grid (degrees), so nearby
+# viewports share downloads and coverage
+REGION_STEP = 0.5
+
+# Edge in degrees of the spatial index cells events are filed under
+INDEX_CELL = 0.25
+INDEX_COLUMNS = int(360 / INDEX_CELL)
+
+# Queries spanning more index cells than this scan by time instead
+MAX_INDEX_CELLS = 500
+
+EARTH_RADIUS_KM = 6371.0
+
+# Range covered by the time slider in map.html
+BACKFILL_START = "1900-01-01"
+BACKFILL_END = "2025-12-31"
+
+# Long windows are fetched as year-aligned chunks; before DENSE_SINCE the
+# catalog is sparse enough to fetch a whole decade per chunk
+DENSE_SINCE = 1970
+SPARSE_CHUNK_YEARS = 10
+
+# Chunks downloaded at the same time, shared by all requests
+FETCH_WORKERS = 4
+
+# Rows written per transaction while a download streams in
+UPSERT_BATCH = 1000
+
+# Seconds the backfill may wait on the upstream rate limiter per chunk
+BACKFILL_MAX_WAIT = 600
+
+# Seconds between two incremental syncs of the background job
+SYNC_INTERVAL = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    time TEXT NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    magnitude REAL,
+    depth REAL,
+    version INTEGER NOT NULL DEFAULT 0,
+    cell INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE TABLE IF NOT EXISTS coverage (
+    starttime TEXT NOT NULL,
+    endtime TEXT NOT NULL,
+    minmagnitude REAL NOT NULL,
+    minlatitude REAL NOT NULL,
+    maxlatitude REAL NOT NULL,
+    minlongitude REAL NOT NULL,
+    maxlongitude REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_local = threading.local()
+# Identical chunk downloads running at the same time share one request
+inflight = upstream.SingleFlight()
+fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="fdsn-fetch")
+
+
+def get_connection():
+    """Return this thread's connection to the catalog, creating it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "path", None) != CATALOG_PATH:
+        conn = sqlite3.connect(CATALOG_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        migrate(conn)
+        _local.conn = conn
+        _local.path = CATALOG_PATH
+    return conn
+
+
+def migrate(conn):
+    """Bring a catalog created by an older version of the app up to SCHEMA."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(events)")}
+    if "version" not in columns:
+        conn.execute("ALTER TABLE events ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS events_version ON events (version)")
+    if "cell" not in columns:
+        conn.execute("ALTER TABLE events ADD COLUMN cell INTEGER")
+        with conn:
+            conn.execute(
+                f"UPDATE events SET cell = CAST((latitude + 90) / {INDEX_CELL} AS INTEGER) * {INDEX_COLUMNS}"
+                f" + CAST((longitude + 180) / {INDEX_CELL} AS INTEGER)"
+            )
+    conn.execute("CREATE INDEX IF NOT EXISTS events_cell ON events (cell, time)")
+    # Coverage recorded before regions existed is for the default one
+    coverage = {row[1] for row in conn.execute("PRAGMA table_info(coverage)")}
+    for name, value in BBOX.items():
+        if name not in coverage:
+            conn.execute(f"ALTER TABLE coverage ADD COLUMN {name} REAL NOT NULL DEFAULT {value}")
+
+
+def normalize_time(value):
+    """Turn a date or datetime string into 'YYYY-MM-DDTHH:MM:SS' (UTC)."""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def utc_now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def build_query_url(starttime, endtime, minmagnitude=None, updatedafter=None, region=None):
+    """Build the FDSN query URL for a region, BBOX by default."""
+    region = region or BBOX
+    url = (
+        f"{FDSN_URL}?format=json&"
+        f"minlatitude={region['minlatitude']}&maxlatitude={region['maxlatitude']}&"
+        f"minlongitude={region['minlongitude']}&maxlongitude={region['maxlongitude']}&"
+        f"starttime={starttime}&endtime={endtime}"
+    )
+    if minmagnitude is not None:
+        url += f"&minmagnitude={minmagnitude}"
+    if updatedafter is not None:
+        url += f"&updatedafter={updatedafter}"
+    return url
+
+
+def snap_region(region):
+    """Widen a region outwards to the REGION_STEP grid."""
+    return {
+        "minlatitude": max(-90.0, math.floor(region["minlatitude"] / REGION_STEP) * REGION_STEP),
+        "maxlatitude": min(90.0, math.ceil(region["maxlatitude"] / REGION_STEP) * REGION_STEP),
+        "minlongitude": max(-180.0, math.floor(region["minlongitude"] / REGION_STEP) * REGION_STEP),
+        "maxlongitude": min(180.0, math.ceil(region["maxlongitude"] / REGION_STEP) * REGION_STEP),
+    }
+
+
+def region_around(latitude, longitude, radius_km):
+    """Smallest region holding the circle of radius_km around a point."""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    coslat = math.cos(math.radians(min(89.9, abs(latitude) + dlat)))
+    dlon = 180.0 if latitude + dlat >= 90 or latitude - dlat <= -90 else min(180.0, dlat / coslat)
+    return {
+        "minlatitude": max(-90.0, latitude - dlat),
+        "maxlatitude": min(90.0, latitude + dlat),
+        "minlongitude": max(-180.0, longitude - dlon),
+        "maxlongitude": min(180.0, longitude + dlon),
+    }
+
+
+def distance_km(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle (haversine) distance; works elementwise on numpy arrays."""
+    latitude1, longitude1, latitude2, longitude2 = map(np.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = (
+        np.sin((latitude2 - latitude1) / 2) ** 2
+        + np.cos(latitude1) * np.cos(latitude2) * np.sin((longitude2 - longitude1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def index_cell(latitude, longitude):
+    """Spatial index cell of a point, as the migration computes it in SQL."""
+    return int((latitude + 90) / INDEX_CELL) * INDEX_COLUMNS + int((longitude + 180) / INDEX_CELL)
+
+
+def index_cells(region):
+    """Index cells overlapping a region, or None when there are too many."""
+    rows = range(
+        int((region["minlatitude"] + 90) / INDEX_CELL),
+        int((min(region["maxlatitude"], 89.999) + 90) / INDEX_CELL) + 1,
+    )
+    columns = range(
+        int((region["minlongitude"] + 180) / INDEX_CELL),
+        int((min(region["maxlongitude"], 179.999) + 180) / INDEX_CELL) + 1,
+    )
+    if len(rows) * len(columns) > MAX_INDEX_CELLS:
+        return None
+    return [row * INDEX_COLUMNS + column for row in rows for column in columns]
+
+
+def event_row(feature):
+    """Turn an FDSN GeoJSON feature into a compact catalog row."""
+    properties = feature['properties']
+    coordinates = feature['geometry']['coordinates']
+    event_id = feature.get('id') or properties.get('unid')
+    if not event_id:
+        event_id = f"{properties['time']}:{coordinates[1]}:{coordinates[0]}"
+    return (
+        event_id,
+        properties['time'],
+        coordinates[1],
+        coordinates[0],
+        properties.get('mag'),
+        properties.get('depth'),
+    )
+
+
+def stream_events(url, max_wait=0):
+    """Yield catalog rows from an FDSN query as its response is read.
+
+    The "features" array is parsed incrementally, so memory stays flat no
+    matter how many events the response holds. max_wait is how long to wait
+    for the upstream rate limiter; request threads don't wait at all.
+    """
+    with upstream.open_stream(url, max_wait=max_wait) as (response, body):
+        print(f"Response Status Code: {response.status_code}")
+        if response.status_code == 204:
+            return
+        response.raise_for_status()
+        for feature in jsonstream.iter_array(body, 'features'):
+            yield event_row(feature)
+
+
+def upsert_events(rows):
+    """Insert rows, replacing any stored event with the same id.
+
+    Rows are consumed in batches so a streamed download is never held in
+    full. Each batch is stamped with the catalog version it creates, so
+    readers can pick up just the events written after a version they hold.
+    Returns the number of rows written.
+    """
+    conn = get_connection()
+    rows = iter(rows)
+    count = 0
+    while True:
+        batch = list(islice(rows, UPSERT_BATCH))
+        if not batch:
+            return count
+        with conn:
+            version = bump_version(conn)
+            conn.executemany(
+                "INSERT OR REPLACE INTO events (id, time, latitude, longitude, magnitude, depth, version, cell) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (row + (version, index_cell(row[2], row[3])) for row in batch),
+            )
+        count += len(batch)
+
+
+def bump_version(conn):
+    """Advance the catalog version and return it.
+
+    Call inside the transaction that changes events: the update takes the
+    write lock, so every writing transaction gets its own version.
+    """
+    conn.execute(
+        "INSERT INTO sync_state (name, value) VALUES ('version', '1') "
+        "ON CONFLICT (name) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO sync_state (name, value) VALUES ('modified', ?)",
+        (utc_now(),),
+    )
+    return int(conn.execute("SELECT value FROM sync_state WHERE name = 'version'").fetchone()[0])
+
+
+def get_version():
+    """Return (version, modified) of the stored events.
+
+    The version changes with every write to the events table, in any
+    process, so it identifies the content a query result was read from.
+    modified is the UTC time of that write, or None for an empty catalog.
+    """
+    rows = dict(get_connection().execute(
+        "SELECT name, value FROM sync_state WHERE name IN ('version', 'modified')"
+    ).fetchall())
+    return int(rows.get('version', 0)), rows.get('modified')
+
+
+def store_chunk(starttime, endtime, minmagnitude=None, max_wait=0, region=None):
+    """Download one time chunk of a region into the store and mark it covered.
+
+    Identical chunks requested at the same time share one download.
+    Returns the number of events stored.
+    """
+    url = build_query_url(starttime, endtime, minmagnitude, region=region)
+    return inflight.do(url, _store_chunk, url, starttime, endtime, minmagnitude, max_wait, region)
+
+
+def _store_chunk(url, starttime, endtime, minmagnitude, max_wait, region):
+    now = utc_now()
+    count = upsert_events(stream_events(url, max_wait))
+    # Nothing after "now" exists yet, so only that much counts as covered
+    if starttime < now:
+        covered_magnitude = float("-inf") if minmagnitude is None else minmagnitude
+        record_coverage(starttime, min(endtime, now), covered_magnitude, region)
+    return count
+
+
+def missing_ranges(starttime, endtime, minmagnitude, region=None):
+    """Return the (start, end) sub-ranges that no stored download covers.
+
+    Only downloads of a region containing `region` (BBOX by default) count.
+    """
+    region = region or BBOX
+    conn = get_connection()
+    rows = conn.execute(
+        "SELECT starttime, endtime FROM coverage "
+        "WHERE minmagnitude <= ? AND endtime > ? AND starttime < ? "
+        "AND minlatitude <= ? AND maxlatitude >= ? AND minlongitude <= ? AND maxlongitude >= ? "
+        "ORDER BY starttime",
+        (
+            minmagnitude, starttime, endtime,
+            region["minlatitude"], region["maxlatitude"], region["minlongitude"], region["maxlongitude"],
+        ),
+    ).fetchall()
+
+    gaps = []
+    cursor = starttime
+    for covered_start, covered_end in rows:
+        if covered_start > cursor:
+            gaps.append((cursor, covered_start))
+        cursor = max(cursor, covered_end)
+        if cursor >= endtime:
+            break
+    if cursor < endtime:
+        gaps.append((cursor, endtime))
+    return gaps
+
+
+def record_coverage(starttime, endtime, minmagnitude, region=None):
+    region = region or BBOX
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO coverage (starttime, endtime, minmagnitude, "
+            "minlatitude, maxlatitude, minlongitude, maxlongitude) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                starttime, endtime, minmagnitude,
+                region["minlatitude"], region["maxlatitude"], region["minlongitude"], region["maxlongitude"],
+            ),
+        )
+
+
+def time_chunks(starttime, endtime):
+    """Split a window into chunks aligned on year (or decade) boundaries.
+
+    Aligned boundaries mean overlapping windows ask for the same chunks, so
+    a chunk stored for one query is reused by the next.
+    """
+    chunks = []
+    cursor = starttime
+    while cursor < endtime:
+        year = int(cursor[:4])
+        step = SPARSE_CHUNK_YEARS if year < DENSE_SINCE else 1
+        boundary = f"{(year // step + 1) * step:04d}-01-01T00:00:00"
+        chunk_end = min(boundary, endtime)
+        chunks.append((cursor, chunk_end))
+        cursor = chunk_end
+    return chunks
+
+
+def fill_gaps(startdate, enddate, minmagnitude=None, max_wait=0, region=None):
+    """Download from upstream whatever part of the window is not stored yet.
+
+    Missing ranges are split into time chunks fetched concurrently on
+    fetch_pool. Each chunk is stored and marked covered as soon as it
+    arrives, so a failed chunk doesn't throw away the others; the store
+    de-duplicates events on chunk boundaries by id.
+
+    A minmagnitude of None downloads every event, which covers any later
+    magnitude filter for that range. Gaps of a region other than BBOX are
+    fetched for the region widened to the REGION_STEP grid.
+    """
+    starttime = normalize_time(startdate)
+    endtime = normalize_time(enddate)
+    covered_magnitude = float("-inf") if minmagnitude is None else minmagnitude
+    chunks = [
+        chunk
+        for gap in missing_ranges(starttime, endtime, covered_magnitude, region)
+        for chunk in time_chunks(*gap)
+    ]
+    if region is not None and region != BBOX:
+        region = snap_region(region)
+    futures = {
+        fetch_pool.submit(store_chunk, chunk_start, chunk_end, minmagnitude, max_wait, region):
+            (chunk_start, chunk_end)
+        for chunk_start, chunk_end in chunks
+    }
+    error = None
+    for future in as_completed(futures):
+        chunk_start, chunk_end = futures[future]
+        try:
+            count = future.result()
+        except requests.exceptions.RequestException as e:
+            print(f"Error fetching {chunk_start} - {chunk_end}: {e}")
+            error = e
+            continue
+        print(f"Catalog filled {chunk_start} - {chunk_end}: {count} events.")
+    if error is not None:
+        raise error
+
+
+def _region_sql(region):
+    """Conditions, each starting with AND, and parameters for a region."""
+    if region is None:
+        return "", []
+    sql, params = "", []
+    cells = index_cells(region)
+    if cells is not None:
+        sql += f" AND cell IN ({','.join('?' * len(cells))})"
+        params += cells
+    sql += " AND latitude >= ? AND latitude <= ? AND longitude >= ? AND longitude <= ?"
+    params += [region["minlatitude"], region["maxlatitude"], region["minlongitude"], region["maxlongitude"]]
+    return sql, params
+
+
+def _filter_sql(startdate, enddate, minmagnitude, region=None):
+    """WHERE clause and parameters for a window, magnitude and region."""
+    region_sql, region_params = _region_sql(region)
+    sql = "time >= ? AND time <= ? AND magnitude >= ?" + region_sql
+    params = [normalize_time(startdate), normalize_time(enddate), minmagnitude] + region_params
+    return sql, params
+
+
+def _events(rows, circle=None):
+    for event_id, latitude, longitude, magnitude, timestamp, depth in rows:
+        if circle is not None and distance_km(circle[0], circle[1], latitude, longitude) > circle[2]:
+            continue
+        yield {
+            'id': event_id,
+            'latitude': latitude,
+            'longitude': longitude,
+            'magnitude': magnitude,
+            'timestamp': timestamp,
+            'depth': depth,
+        }
+
+
+def iter_query(startdate, enddate, minmagnitude, region=None, circle=None):
+    """Yield stored events in the window with magnitude >= minmagnitude, by time.
+
+    region limits the events to a box, read through the spatial index when
+    it spans few enough cells; circle is (latitude, longitude, radius_km).
+    """
+    if circle is not None:
+        region = region_around(*circle)
+    where, params = _filter_sql(startdate, enddate, minmagnitude, region)
+    rows = get_connection().execute(
+        f"SELECT id, latitude, longitude, magnitude, time, depth FROM events WHERE {where} ORDER BY time",
+        params,
+    )
+    yield from _events(rows, circle)
+
+
+def diff(old, new, region=None, circle=None, since=None):
+    """Compare two (startdate, enddate, minmagnitude) filters over one area.
+
+    Returns (removed, added): the ids of stored events matching `old` but
+    not `new`, and the events matching `new` but not `old`, by time. With
+    `since`, events of the area written after that catalog version are
+    added as well if they match `new` and removed if they don't, so a
+    client holding the `old` result read at `since` can replace them by id.
+    """
+    if circle is not None:
+        region = region_around(*circle)
+    old_where, old_params = _filter_sql(*old, region)
+    new_where, new_params = _filter_sql(*new, region)
+    # The same tests without the region, to tell the two result sets apart
+    old_test, old_test_params = _filter_sql(*old)
+    new_test, new_test_params = _filter_sql(*new)
+    conn = get_connection()
+
+    rows = conn.execute(
+        f"SELECT id, latitude, longitude, magnitude, time, depth FROM events "
+        f"WHERE {old_where} AND NOT ({new_test})",
+        old_params + new_test_params,
+    )
+    removed = [event['id'] for event in _events(rows, circle)]
+
+    if since is not None:
+        # Revised since the client's read so that they left the new result,
+        # whether or not they still match `old`
+        region_sql, region_params = _region_sql(region)
+        rows = conn.execute(
+            f"SELECT id, latitude, longitude, ({new_test}) FROM events WHERE version > ?{region_sql}",
+            new_test_params + [since] + region_params,
+        )
+        removed += [
+            event_id for event_id, latitude, longitude, matches in rows
+            if not matches or (
+                circle is not None and distance_km(circle[0], circle[1], latitude, longitude) > circle[2]
+            )
+        ]
+        removed = list(dict.fromkeys(removed))
+
+    changed = ""
+    changed_params = []
+    if since is not None:
+        changed = " OR version > ?"
+        changed_params = [since]
+    rows = conn.execute(
+        f"SELECT id, latitude, longitude, magnitude, time, depth FROM events "
+        f"WHERE {new_where} AND (NOT ({old_test}){changed}) ORDER BY time",
+        new_params + old_test_params + changed_params,
+    )
+    return removed, list(_events(rows, circle))
+
+
+def query(startdate, enddate, minmagnitude, region=None, circle=None):
+    """Return stored events in the window with magnitude >= minmagnitude."""
+    return list(iter_query(startdate, enddate, minmagnitude, region, circle))
+
+
+def query_arrays(startdate, enddate, minmagnitude, after_version=-1, upto_version=None):
+    """Return (latitude, longitude, magnitude) arrays of matching events.
+
+    Only events written in catalog versions after_version < v <= upto_version
+    are included; magnitude is NaN where unknown.
+    """
+    if upto_version is None:
+        upto_version = get_version()[0]
+    rows = get_connection().execute(
+        "SELECT latitude, longitude, magnitude FROM events "
+        "WHERE time >= ? AND time <= ? AND magnitude >= ? AND version > ? AND version <= ?",
+        (normalize_time(startdate), normalize_time(enddate), minmagnitude, after_version, upto_version),
+    ).fetchall()
+    columns = np.array(rows, dtype=float).reshape(len(rows), 3)
+    return columns[:, 0], columns[:, 1], columns[:, 2]
+
+
+def count(startdate, enddate, minmagnitude, upto_version=None):
+    """Number of matching events written up to upto_version."""
+    if upto_version is None:
+        upto_version = get_version()[0]
+    return get_connection().execute(
+        "SELECT COUNT(*) FROM events WHERE time >= ? AND time <= ? AND magnitude >= ? AND version <= ?",
+        (normalize_time(startdate), normalize_time(enddate), minmagnitude, upto_version),
+    ).fetchone()[0]
+
+
+def rows_since(after_version=-1, upto_version=None):
+    """Return (id, time, latitude, longitude, magnitude, depth) rows by time.
+
+    Only events written in catalog versions after_version < v <= upto_version
+    are included.
+    """
+    if upto_version is None:
+        upto_version = get_version()[0]
+    return get_connection().execute(
+        "SELECT id, time, latitude, longitude, magnitude, depth FROM events "
+        "WHERE version > ? AND version <= ? ORDER BY time",
+        (after_version, upto_version),
+    ).fetchall()
+
+
+def count_all(upto_version=None):
+    """Number of stored events written up to upto_version."""
+    if upto_version is None:
+        upto_version = get_version()[0]
+    return get_connection().execute(
+        "SELECT COUNT(*) FROM events WHERE version <= ?", (upto_version,)
+    ).fetchone()[0]
+
+
+def get_sync_cursor():
+    """Return the time of the last successful sync, or None."""
+    row = get_connection().execute(
+        "SELECT value FROM sync_state WHERE name = 'updatedafter'"
+    ).fetchone()
+    return row[0] if row else None
+
+
+def set_sync_cursor(value):
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state (name, value) VALUES ('updatedafter', ?)",
+            (value,),
+        )
+
+
+def backfill(start_year, end_year):
+    """Download every event in the bounding box from start_year to end_year."""
+    started = utc_now()
+    fill_gaps(f"{start_year}-01-01", f"{end_year + 1}-01-01", max_wait=BACKFILL_MAX_WAIT)
+    # Later syncs only need what was created or revised after the backfill began
+    if get_sync_cursor() is None:
+        set_sync_cursor(started)
+
+
+def sync_updates():
+    """Fetch events created or updated since the last sync and upsert them.
+
+    Returns the number of events received, so the cost of a sync follows the
+    amount of new activity rather than the size of the catalog.
+    """
+    cursor = get_sync_cursor()
+    if cursor is None:
+        newest = get_connection().execute("SELECT MAX(time) FROM events").fetchone()[0]
+        if newest is None:
+            # Empty catalog: there is nothing to update, gap filling does the rest
+            set_sync_cursor(utc_now())
+            return 0
+        cursor = normalize_time(newest)
+
+    # Taken before the request so nothing revised meanwhile is skipped next time
+    started = utc_now()
+    url = build_query_url(BACKFILL_START + "T00:00:00", started, updatedafter=cursor)
+    count = upsert_events(stream_events(url))
+    # Anything that happened since the cursor was also created since then
+    record_coverage(cursor, started, float("-inf"))
+    set_sync_cursor(started)
+    print(f"Catalog sync since {cursor}: {count} events.")
+    return count
+
+
+def run_sync_loop(interval=SYNC_INTERVAL):
+    while True:
+        try:
+            sync_updates()
+        except requests.exceptions.RequestException as e:
+            # Keep the old cursor, the next round asks for the same window again
+            print(f"Catalog sync failed: {e}")
+        time.sleep(interval)
+
+
+def acquire_sync_lock():
+    """Lock SYNC_LOCK_PATH for the background sync of this process.
+
+    Returns the open lock file, to be kept open for as long as the process
+    syncs, or None when another process holds the lock. The lock goes away
+    with the process, so a crashed syncer doesn't leave it behind.
+    """
+    file = open(SYNC_LOCK_PATH, "w")
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        file.close()
+        return None
+    return file
+
+
+def start_sync_thread(interval=SYNC_INTERVAL):
+    """Run sync_updates every `interval` seconds in a daemon thread."""
+    thread = threading.Thread(target=run_sync_loop, args=(interval,), daemon=True)
+    thread.start()
+    return thread
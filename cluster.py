@@ -0,0 +1,148 @@
+"""Server-side marker clustering for the map's earthquake layer.
+
+Like supercluster, events are projected to Web Mercator and merged greedily,
+zoom by zoom from MAX_CLUSTER_ZOOM down to 0: every point (or cluster of the
+level above) absorbs its unclaimed neighbours within RADIUS pixels into a
+count-weighted centroid. The levels are built once per filter tuple and
+catalog version, so a request only selects the clusters inside its bbox.
+Individual events are returned only past MAX_CLUSTER_ZOOM.
+"""
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import catalog
+import heatmap
+from upstream import SingleFlight
+
+# Deepest zoom with clusters; beyond it the events themselves are returned
+MAX_CLUSTER_ZOOM = 14
+
+# Cluster radius in screen pixels
+RADIUS = 40
+
+# Indexes kept in memory, one per (starttime, endtime, minmagnitude)
+MAX_INDEXES = 8
+
+
+class ClusterLevel:
+    """Clusters of one zoom level, in zoom-0 pixels and in degrees."""
+
+    def __init__(self, x, y, count, magnitude):
+        self.x = x
+        self.y = y
+        self.count = count
+        self.magnitude = magnitude
+        self.longitude = x / heatmap.TILE_SIZE * 360.0 - 180.0
+        self.latitude = np.degrees(np.arctan(np.sinh(math.pi * (1.0 - 2.0 * y / heatmap.TILE_SIZE))))
+
+    def __len__(self):
+        return len(self.x)
+
+    def inside(self, bbox):
+        """Indexes of the clusters inside bbox (minlon, minlat, maxlon, maxlat)."""
+        if bbox is None:
+            return np.arange(len(self))
+        minlon, minlat, maxlon, maxlat = bbox
+        return np.flatnonzero(
+            (self.longitude >= minlon) & (self.longitude <= maxlon)
+            & (self.latitude >= minlat) & (self.latitude <= maxlat)
+        )
+
+    def merge(self, radius):
+        """Return the level above: points within `radius` pixels merged greedily."""
+        n = len(self)
+        if n < 2:
+            return self
+        points = np.column_stack((self.x, self.y))
+        tree = cKDTree(points)
+        # Points with no neighbour in range carry over as they are
+        distance, _ = tree.query(points, k=2)
+        labels = np.full(n, -1)
+        isolated = np.flatnonzero(distance[:, 1] > radius)
+        labels[isolated] = np.arange(len(isolated))
+        next_label = len(isolated)
+        for i in np.flatnonzero(distance[:, 1] <= radius):
+            if labels[i] >= 0:
+                continue
+            members = [j for j in tree.query_ball_point(points[i], radius) if labels[j] < 0]
+            labels[members] = next_label
+            next_label += 1
+
+        count = np.bincount(labels, weights=self.count, minlength=next_label)
+        x = np.bincount(labels, weights=self.x * self.count, minlength=next_label) / count
+        y = np.bincount(labels, weights=self.y * self.count, minlength=next_label) / count
+        magnitude = np.full(next_label, np.nan)
+        np.fmax.at(magnitude, labels, self.magnitude)
+        return ClusterLevel(x, y, count.astype(np.int64), magnitude)
+
+
+class ClusterIndex:
+    """Every zoom level's clusters for one filter tuple at a catalog version."""
+
+    def __init__(self, version, events):
+        self.version = version
+        self.events = [
+            event for event in events
+            if event['latitude'] is not None and event['longitude'] is not None
+        ]
+        latitude = np.array([event['latitude'] for event in self.events], dtype=float)
+        longitude = np.array([event['longitude'] for event in self.events], dtype=float)
+        magnitude = np.array([event['magnitude'] for event in self.events], dtype=float)
+        x, y = heatmap.project(latitude, longitude)
+        self.points = ClusterLevel(x, y, np.ones(len(x), dtype=np.int64), magnitude)
+
+        self.levels = [None] * (MAX_CLUSTER_ZOOM + 1)
+        level = self.points
+        for z in range(MAX_CLUSTER_ZOOM, -1, -1):
+            level = self.levels[z] = level.merge(RADIUS / 2 ** z)
+
+    def clusters(self, z, bbox=None):
+        """Return [lat, lon, count, max magnitude] for the clusters at zoom z."""
+        level = self.levels[max(0, z)]
+        return [
+            [
+                round(float(level.latitude[i]), 5),
+                round(float(level.longitude[i]), 5),
+                int(level.count[i]),
+                None if np.isnan(level.magnitude[i]) else round(float(level.magnitude[i]), 1),
+            ]
+            for i in level.inside(bbox)
+        ]
+
+    def events_in(self, bbox=None):
+        """Return the individual events inside bbox, in time order."""
+        return [self.events[i] for i in self.points.inside(bbox)]
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+_builds = SingleFlight()
+
+
+def get_index(starttime, endtime, minmagnitude):
+    """Return the cluster index for a filter tuple at the current catalog version."""
+    key = (starttime, endtime, minmagnitude)
+    version = catalog.get_version()[0]
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None and index.version == version:
+            _indexes.move_to_end(key)
+            return index
+
+    index = _builds.do(key + (version,), _build_index, key, version)
+    with _indexes_lock:
+        current = _indexes.get(key)
+        if current is None or current.version < index.version:
+            _indexes[key] = index
+        _indexes.move_to_end(key)
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def _build_index(key, version):
+    return ClusterIndex(version, catalog.query(*key))
@@ -0,0 +1,355 @@
+"""The local catalog as sorted NumPy columns.
+
+Events are kept in parallel arrays ordered by time: time as int64
+milliseconds since the epoch, coordinates, depth and magnitude as float32.
+A date window is then two searchsorted calls, and the magnitude filter a
+vectorized mask over that slice only. An index of the event ids, sorted,
+with the row of each, finds the old rows of events revised upstream.
+
+The columns are also saved as .npy files with a small manifest, which every
+worker memory-maps on its first query instead of reading the catalog: the
+OS page cache holds one copy for all of them, so startup time and resident
+memory don't grow with the catalog. The mapped columns are never copied or
+changed. Events written since are kept in a small delta in memory and laid
+over them (see LayeredColumns), until the next saved snapshot, which is
+mapped once the manifest changes. Snapshots are written by the sync
+commands and the save thread of `flask sync-daemon`, never on a request.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import catalog
+import formats
+
+COLUMNS = ('time', 'latitude', 'longitude', 'magnitude', 'depth')
+
+# The id index: event ids as sorted bytes, and the row of each
+INDEX_COLUMNS = ('id_keys', 'id_rows')
+
+# Directory of saved snapshots, next to the SQLite catalog
+SNAPSHOT_DIR = "earthquake_catalog.columns"
+MANIFEST_PATH = os.path.join(SNAPSHOT_DIR, "manifest.json")
+SNAPSHOT_FORMAT = 2
+
+# Seconds between two saves by the save thread, so a running sync doesn't
+# rewrite every batch
+SAVE_INTERVAL = 60
+
+# Saved versions kept on disk; older ones may still be mapped by a worker
+KEEP_SNAPSHOTS = 2
+
+# Events in a delta before a worker folds it into private columns; only
+# reached when no snapshot is saved for a long time
+MAX_DELTA = 100_000
+
+
+def to_ms(value):
+    """Milliseconds since the epoch for a normalized catalog time."""
+    return int(np.datetime64(value, 'ms').astype(np.int64))
+
+
+class Columns:
+    """Events in time order at one catalog version. Never modified in place.
+
+    Columns returned by select() have no id index (id_keys and id_rows are
+    None) and can't be merged.
+    """
+
+    def __init__(self, version, time, latitude, longitude, magnitude, depth, id_keys=None, id_rows=None):
+        self.version = version
+        self.time = time
+        self.latitude = latitude
+        self.longitude = longitude
+        self.magnitude = magnitude
+        self.depth = depth
+        self.id_keys = id_keys
+        self.id_rows = id_rows
+
+    @classmethod
+    def empty(cls, version=-1):
+        return cls(
+            version, np.empty(0, np.int64), *(np.empty(0, np.float32) for _ in range(4)),
+            np.empty(0, 'S1'), np.empty(0, np.int64),
+        )
+
+    @classmethod
+    def from_rows(cls, version, rows):
+        """Build columns from (id, time, latitude, longitude, magnitude, depth) rows."""
+        if not rows:
+            return cls.empty(version)
+        ids, times, latitude, longitude, magnitude, depth = zip(*rows)
+        floats = np.array([latitude, longitude, magnitude, depth], dtype=float).astype(np.float32)
+        time = formats.epoch_ms(times)
+        order = np.argsort(time, kind='stable')
+        ids = np.array([event_id.encode() for event_id in ids], dtype='S')
+        by_id = np.argsort(ids, kind='stable')
+        # Row in time order of each input row
+        rows_in_order = np.empty(len(order), np.int64)
+        rows_in_order[order] = np.arange(len(order))
+        return cls(version, time[order], *(column[order] for column in floats), ids[by_id], rows_in_order[by_id])
+
+    def __len__(self):
+        return len(self.time)
+
+    def merge(self, version, other):
+        """Return these events with `other`'s merged in, at `version`.
+
+        An event of `other` that is already held, i.e. was revised since,
+        replaces the held row; the others are inserted in time order. Costs
+        vectorized passes over the columns, no sort of them.
+        """
+        if not len(other):
+            return Columns(version, *(getattr(self, name) for name in COLUMNS + INDEX_COLUMNS))
+        width = max(self.id_keys.dtype.itemsize, other.id_keys.dtype.itemsize)
+        id_keys = self.id_keys.astype(f'S{width}', copy=False)
+        new_keys = other.id_keys.astype(f'S{width}', copy=False)
+        id_rows = self.id_rows
+        columns = [getattr(self, name) for name in COLUMNS]
+
+        found = np.searchsorted(id_keys, new_keys)
+        held = found < len(id_keys)
+        held[held] = id_keys[found[held]] == new_keys[held]
+        if held.any():
+            # Drop the old rows of revised events, and their index entries
+            keep = np.ones(len(self), dtype=bool)
+            keep[id_rows[found[held]]] = False
+            columns = [column[keep] for column in columns]
+            kept_keys = np.ones(len(id_keys), dtype=bool)
+            kept_keys[found[held]] = False
+            id_keys = id_keys[kept_keys]
+            id_rows = (np.cumsum(keep) - 1)[id_rows[kept_keys]]
+
+        positions = np.searchsorted(columns[0], other.time, side='right')
+        columns = [np.insert(column, positions, getattr(other, name)) for column, name in zip(columns, COLUMNS)]
+        # Rows held move down by the number of rows inserted at or before them
+        id_rows = id_rows + np.searchsorted(positions, id_rows, side='right')
+        inserted_rows = positions + np.arange(len(other))
+        key_positions = np.searchsorted(id_keys, new_keys)
+        return Columns(
+            version, *columns,
+            np.insert(id_keys, key_positions, new_keys),
+            np.insert(id_rows, key_positions, inserted_rows[other.id_rows]),
+        )
+
+    def select(self, starttime, endtime, minmagnitude, region=None, circle=None, hidden=None):
+        """Return the events in [starttime, endtime] with magnitude >= minmagnitude.
+
+        region and circle narrow the area as in catalog.iter_query(). hidden
+        is a sorted array of rows to leave out.
+        """
+        lo = np.searchsorted(self.time, to_ms(starttime), side='left')
+        hi = np.searchsorted(self.time, to_ms(endtime), side='right')
+        # Compared in float32 so an event at exactly minmagnitude passes; unknown
+        # (NaN) magnitudes never do, as in the SQL query
+        mask = self.magnitude[lo:hi] >= np.float32(minmagnitude)
+        if hidden is not None and len(hidden):
+            mask[hidden[np.searchsorted(hidden, lo):np.searchsorted(hidden, hi)] - lo] = False
+        if circle is not None:
+            region = catalog.region_around(*circle)
+        if region is not None:
+            latitude, longitude = self.latitude[lo:hi], self.longitude[lo:hi]
+            mask &= (
+                (latitude >= np.float32(region['minlatitude'])) & (latitude <= np.float32(region['maxlatitude']))
+                & (longitude >= np.float32(region['minlongitude'])) & (longitude <= np.float32(region['maxlongitude']))
+            )
+        if circle is not None:
+            indexes = np.flatnonzero(mask)
+            distance = catalog.distance_km(
+                circle[0], circle[1], self.latitude[lo:hi][indexes], self.longitude[lo:hi][indexes]
+            )
+            mask[indexes[distance > circle[2]]] = False
+        return Columns(self.version, *(getattr(self, name)[lo:hi][mask] for name in COLUMNS))
+
+
+class LayeredColumns:
+    """Read-only base columns with the events written since laid over them.
+
+    The base, usually a mapped snapshot, is never copied or changed. The
+    events written after it, new or revised, are in delta, a Columns in
+    memory with its own id index, and the base rows of revised events are
+    hidden by superseded, a sorted array of rows. Both stay small between
+    two saved snapshots. Never modified in place.
+    """
+
+    def __init__(self, base, version=None, delta=None, superseded=None):
+        self.base = base
+        self.version = base.version if version is None else version
+        self.delta = Columns.empty(self.version) if delta is None else delta
+        self.superseded = np.empty(0, np.int64) if superseded is None else superseded
+
+    def __len__(self):
+        return len(self.base) - len(self.superseded) + len(self.delta)
+
+    def merge(self, version, other):
+        """Return these events with `other`'s laid over them, at `version`."""
+        if not len(other):
+            return LayeredColumns(self.base, version, self.delta, self.superseded)
+        delta = self.delta.merge(version, other)
+        # Ids longer than the base's can't be held in it
+        width = self.base.id_keys.dtype.itemsize
+        keys = other.id_keys[np.char.str_len(other.id_keys) <= width].astype(self.base.id_keys.dtype)
+        found = np.searchsorted(self.base.id_keys, keys)
+        held = found < len(self.base.id_keys)
+        held[held] = self.base.id_keys[found[held]] == keys[held]
+        superseded = np.union1d(self.superseded, self.base.id_rows[found[held]])
+        layered = LayeredColumns(self.base, version, delta, superseded)
+        if len(delta) > MAX_DELTA:
+            return LayeredColumns(layered.columns())
+        return layered
+
+    def columns(self):
+        """The events as one Columns with an id index, for saving.
+
+        Costs a copy of every column unless nothing was written since the base.
+        """
+        return self.base.merge(self.version, self.delta)
+
+    def select(self, starttime, endtime, minmagnitude, region=None, circle=None):
+        """Return the events in [starttime, endtime] with magnitude >= minmagnitude, as Columns.select()."""
+        selected = self.base.select(starttime, endtime, minmagnitude, region, circle, self.superseded)
+        new = self.delta.select(starttime, endtime, minmagnitude, region, circle)
+        # Written events go after base events at the same time, as in Columns.merge()
+        positions = np.searchsorted(selected.time, new.time, side='right')
+        return Columns(
+            self.version, *(np.insert(getattr(selected, name), positions, getattr(new, name)) for name in COLUMNS)
+        )
+
+
+def save(layered):
+    """Write the columns of snapshot() as a snapshot and point the manifest at it.
+
+    The manifest is replaced atomically once the files are complete, so
+    readers only ever see a whole snapshot.
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    manifest = read_manifest()
+    if manifest is not None and layered.version <= manifest['version'] <= catalog.get_version()[0]:
+        return
+    columns = layered.columns()
+    # A fresh directory per save, so no reader ever sees files change
+    directory = tempfile.mkdtemp(prefix=f"v{columns.version}-", dir=SNAPSHOT_DIR)
+    for column in COLUMNS + INDEX_COLUMNS:
+        np.save(os.path.join(directory, f"{column}.npy"), getattr(columns, column))
+    name = os.path.basename(directory)
+
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'version': columns.version,
+        'directory': name,
+        'count': len(columns),
+        'bbox': catalog.BBOX,
+        'first_time': str(columns.time[0].astype('datetime64[ms]')) if len(columns) else None,
+        'last_time': str(columns.time[-1].astype('datetime64[ms]')) if len(columns) else None,
+        'columns': {column: str(getattr(columns, column).dtype) for column in COLUMNS + INDEX_COLUMNS},
+    }
+    fd, staging = tempfile.mkstemp(prefix=".manifest-", dir=SNAPSHOT_DIR)
+    with os.fdopen(fd, "w") as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(staging, MANIFEST_PATH)
+    print(f"Saved catalog snapshot {name}: {len(columns)} events.")
+    remove_old_snapshots(name)
+
+
+def read_manifest():
+    """Return the snapshot manifest, or None if there is no usable one."""
+    try:
+        with open(MANIFEST_PATH) as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+    if manifest.get('format') != SNAPSHOT_FORMAT or manifest.get('bbox') != catalog.BBOX:
+        return None
+    return manifest
+
+
+def load():
+    """Memory-map the saved snapshot; None when there isn't one."""
+    manifest = read_manifest()
+    if manifest is None:
+        return None
+    directory = os.path.join(SNAPSHOT_DIR, manifest['directory'])
+    try:
+        arrays = [
+            np.load(os.path.join(directory, f"{column}.npy"), mmap_mode='r') for column in COLUMNS + INDEX_COLUMNS
+        ]
+    except (OSError, ValueError) as e:
+        print(f"Ignoring catalog snapshot {directory}: {e}")
+        return None
+    return Columns(manifest['version'], *arrays)
+
+
+def remove_old_snapshots(current):
+    paths = sorted(
+        (os.path.join(SNAPSHOT_DIR, name) for name in os.listdir(SNAPSHOT_DIR) if name.startswith('v')),
+        key=os.path.getmtime,
+    )
+    for path in paths[:-KEEP_SNAPSHOTS]:
+        # Unlinking is safe on POSIX while a worker still maps the files
+        if os.path.basename(path) != current:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def manifest_mtime():
+    try:
+        return os.stat(MANIFEST_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+_columns = LayeredColumns(Columns.empty())
+_manifest_mtime = -1
+_lock = threading.Lock()
+
+
+def snapshot():
+    """Return the catalog's events at its current version, as LayeredColumns.
+
+    The saved snapshot is mapped on the first call and whenever a newer one
+    has been saved since. Events written after it, new or revised, are laid
+    over it. If the counts then don't add up (events were removed, or the
+    snapshot belongs to another database) the columns are rebuilt from the
+    store. Nothing is written here; see save() and start_save_thread().
+    """
+    global _columns, _manifest_mtime
+    with _lock:
+        version = catalog.get_version()[0]
+        mtime = manifest_mtime()
+        if mtime != _manifest_mtime:
+            _manifest_mtime = mtime
+            saved = load()
+            # A snapshot ahead of the store was saved from another database
+            if saved is not None and _columns.version <= saved.version <= version:
+                _columns = LayeredColumns(saved)
+        if version == _columns.version:
+            return _columns
+        new = Columns.from_rows(version, catalog.rows_since(_columns.version, version))
+        if _columns.version >= 0:
+            new = _columns.merge(version, new)
+            if catalog.count_all(version) != len(new):
+                new = LayeredColumns(Columns.from_rows(version, catalog.rows_since(-1, version)))
+        else:
+            new = LayeredColumns(new)
+        _columns = new
+        return _columns
+
+
+def run_save_loop(interval=SAVE_INTERVAL):
+    while True:
+        time.sleep(interval)
+        try:
+            save(snapshot())
+        except OSError as e:
+            print(f"Saving the catalog snapshot failed: {e}")
+
+
+def start_save_thread(interval=SAVE_INTERVAL):
+    """Save the columns every `interval` seconds, when they changed, in a daemon thread."""
+    thread = threading.Thread(target=run_save_loop, args=(interval,), daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,84 @@
+"""Event counts for every slider combination, from a year x magnitude cube.
+
+Stored events of the map's region are counted per calendar year and per
+0.1 magnitude bin, then prefix-summed over years and suffix-summed over
+magnitudes. The number of events between two years with at least a given
+magnitude is then four lookups, whatever the catalog size, so the page can
+show it live while a slider is dragged.
+"""
+import math
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+import catalog
+import columnar
+
+FIRST_YEAR = int(catalog.BACKFILL_START[:4])
+
+# Magnitude bins of the slider; stronger events share the top bin
+MAGNITUDE_STEP = 0.1
+MAX_MAGNITUDE = 7.2
+MAGNITUDE_BINS = round(MAX_MAGNITUDE / MAGNITUDE_STEP) + 1
+
+
+def magnitude_bin(minmagnitude):
+    """Lowest bin counted for a minmagnitude, clamped to the cube."""
+    return min(MAGNITUDE_BINS, max(0, math.ceil(minmagnitude / MAGNITUDE_STEP - 1e-6)))
+
+
+class CountCube:
+    """Cumulative counts of one catalog version.
+
+    cumulative[y, m] is the number of events before year FIRST_YEAR + y
+    with magnitude bin >= m; it has one extra row and column of zeros.
+    """
+
+    def __init__(self, version, time, magnitude, last_year):
+        self.version = version
+        self.last_year = last_year
+        years = last_year - FIRST_YEAR + 1
+        known = ~np.isnan(magnitude)
+        year = time[known].astype('datetime64[ms]').astype('datetime64[Y]').astype(np.int64) + 1970
+        bins = np.floor(magnitude[known].astype(float) / MAGNITUDE_STEP + 1e-6).astype(np.int64)
+        inside = (year >= FIRST_YEAR) & (year <= last_year)
+        counts = np.zeros((years, MAGNITUDE_BINS), dtype=np.int64)
+        np.add.at(counts, (year[inside] - FIRST_YEAR, np.clip(bins[inside], 0, MAGNITUDE_BINS - 1)), 1)
+
+        self.cumulative = np.zeros((years + 1, MAGNITUDE_BINS + 1), dtype=np.int64)
+        # Events of magnitude >= bin m: suffix sum along the magnitude axis
+        self.cumulative[1:, :-1] = np.cumsum(np.cumsum(counts[:, ::-1], axis=1)[:, ::-1], axis=0)
+
+    def count(self, start_year, end_year, minmagnitude):
+        """Events from the start of start_year to the end of end_year."""
+        y0 = min(max(start_year, FIRST_YEAR), self.last_year + 1) - FIRST_YEAR
+        y1 = min(max(end_year + 1, FIRST_YEAR), self.last_year + 1) - FIRST_YEAR
+        if y1 <= y0:
+            return 0
+        m = magnitude_bin(minmagnitude)
+        return int(self.cumulative[y1, m] - self.cumulative[y0, m])
+
+    def to_dict(self):
+        return {
+            'first_year': FIRST_YEAR,
+            'last_year': self.last_year,
+            'magnitude_step': MAGNITUDE_STEP,
+            'cumulative': self.cumulative.tolist(),
+        }
+
+
+_cube = None
+_lock = threading.Lock()
+
+
+def get_cube():
+    """Return the count cube at the current catalog version."""
+    global _cube
+    with _lock:
+        columns = columnar.snapshot()
+        last_year = max(int(catalog.BACKFILL_END[:4]), datetime.now(timezone.utc).year)
+        if _cube is None or _cube.version != columns.version or _cube.last_year != last_year:
+            region = columns.select(catalog.BACKFILL_START, f"{last_year}-12-31T23:59:59", float('-inf'), catalog.BBOX)
+            _cube = CountCube(columns.version, region.time, region.magnitude, last_year)
+        return _cube
@@ -0,0 +1,295 @@
+"""Server-side density grids for the map's heatmap layer.
+
+Instead of shipping every event to leaflet.heat, events are binned into
+magnitude-weighted cells with numpy.histogram2d at every zoom level up to
+MAX_GRID_ZOOM. Such a pyramid is built once per filter tuple; when the
+catalog changes, only the events written since the pyramid's version are
+added to it. The same events are also rendered into PNG heat tiles.
+"""
+import math
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+from scipy.signal import fftconvolve
+
+import catalog
+import columnar
+
+# Finest precomputed level; deeper map zooms reuse it
+MAX_GRID_ZOOM = 11
+
+# Cells across one 256px map tile, i.e. one cell per 8 pixels
+CELLS_PER_TILE = 32
+
+# Pyramids kept in memory, one per (starttime, endtime, minmagnitude)
+MAX_PYRAMIDS = 16
+
+
+def cell_size(z):
+    """Edge of a grid cell in degrees at zoom level z."""
+    return 360.0 / (2 ** z) / CELLS_PER_TILE
+
+
+class Level:
+    """One zoom level: weight and count grids over a cell-aligned box."""
+
+    def __init__(self, z, bbox):
+        self.z = z
+        self.size = cell_size(z)
+        self.lon0 = math.floor(bbox['minlongitude'] / self.size) * self.size
+        self.lat0 = math.floor(bbox['minlatitude'] / self.size) * self.size
+        self.nx = max(1, math.ceil((bbox['maxlongitude'] - self.lon0) / self.size))
+        self.ny = max(1, math.ceil((bbox['maxlatitude'] - self.lat0) / self.size))
+        self.weights = np.zeros((self.ny, self.nx), dtype=np.float32)
+        self.counts = np.zeros((self.ny, self.nx), dtype=np.int32)
+
+    def add(self, latitude, longitude, weights):
+        bins = (self.ny, self.nx)
+        extent = ((self.lat0, self.lat0 + self.ny * self.size), (self.lon0, self.lon0 + self.nx * self.size))
+        weighted, _, _ = np.histogram2d(latitude, longitude, bins=bins, range=extent, weights=weights)
+        counted, _, _ = np.histogram2d(latitude, longitude, bins=bins, range=extent)
+        self.weights += weighted.astype(np.float32)
+        self.counts += counted.astype(np.int32)
+
+    def cells(self, bbox=None):
+        """Return [lat, lon, weight, count] for the non-empty cells inside bbox.
+
+        lat/lon are cell centres; bbox is (minlon, minlat, maxlon, maxlat).
+        """
+        x0, y0, x1, y1 = 0, 0, self.nx, self.ny
+        if bbox is not None:
+            minlon, minlat, maxlon, maxlat = bbox
+            x0 = min(self.nx, max(0, math.floor((minlon - self.lon0) / self.size)))
+            x1 = min(self.nx, max(0, math.ceil((maxlon - self.lon0) / self.size)))
+            y0 = min(self.ny, max(0, math.floor((minlat - self.lat0) / self.size)))
+            y1 = min(self.ny, max(0, math.ceil((maxlat - self.lat0) / self.size)))
+        counts = self.counts[y0:y1, x0:x1]
+        rows, columns = np.nonzero(counts)
+        latitude = self.lat0 + (rows + y0 + 0.5) * self.size
+        longitude = self.lon0 + (columns + x0 + 0.5) * self.size
+        weights = self.weights[y0:y1, x0:x1][rows, columns]
+        return [
+            [round(float(lat), 5), round(float(lon), 5), round(float(weight), 2), int(count)]
+            for lat, lon, weight, count in zip(latitude, longitude, weights, counts[rows, columns])
+        ]
+
+
+class Pyramid:
+    """Grids for every zoom level of one filter tuple, at a catalog version."""
+
+    def __init__(self, bbox):
+        self.bbox = bbox
+        self.version = -1
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.levels = [Level(z, self.bbox) for z in range(MAX_GRID_ZOOM + 1)]
+        self.count = 0
+
+    def add(self, latitude, longitude, magnitude):
+        # Weighted by magnitude, as the client-side heat layer did
+        weights = np.where(np.isnan(magnitude), 1.0, magnitude)
+        for level in self.levels:
+            level.add(latitude, longitude, weights)
+        self.count += len(latitude)
+
+    def level(self, z):
+        return self.levels[max(0, min(MAX_GRID_ZOOM, z))]
+
+
+_pyramids = OrderedDict()
+_pyramids_lock = threading.Lock()
+
+
+def get_pyramid(starttime, endtime, minmagnitude):
+    """Return the pyramid for a filter tuple, brought up to the catalog version.
+
+    New events are added incrementally. If events counted before were
+    revised or removed meanwhile, the matching count no longer adds up and
+    the pyramid is rebuilt from scratch.
+    """
+    key = (starttime, endtime, minmagnitude)
+    with _pyramids_lock:
+        pyramid = _pyramids.get(key)
+        if pyramid is None:
+            pyramid = _pyramids[key] = Pyramid(catalog.BBOX)
+        _pyramids.move_to_end(key)
+        while len(_pyramids) > MAX_PYRAMIDS:
+            _pyramids.popitem(last=False)
+
+    with pyramid.lock:
+        version = catalog.get_version()[0]
+        if version == pyramid.version:
+            return pyramid
+        latitude, longitude, magnitude = catalog.query_arrays(
+            starttime, endtime, minmagnitude, after_version=pyramid.version, upto_version=version
+        )
+        total = catalog.count(starttime, endtime, minmagnitude, upto_version=version)
+        if pyramid.version >= 0 and total != pyramid.count + len(latitude):
+            pyramid.reset()
+            latitude, longitude, magnitude = catalog.query_arrays(
+                starttime, endtime, minmagnitude, upto_version=version
+            )
+        pyramid.add(latitude, longitude, magnitude)
+        pyramid.version = version
+    return pyramid
+
+
+# Heat tiles ---------------------------------------------------------------
+#
+# /tiles/heat/{z}/{x}/{y}.png renders what leaflet.heat used to draw in the
+# browser: each event is splatted with intensity magnitude / 2^(12 - z)
+# (leaflet.heat's maxZoom scaling), the splats are summed with an FFT
+# convolution of the binned grid, and the result is coloured with the
+# gradient from the map legend.
+
+TILE_SIZE = 256
+
+# Deepest zoom of the map's tile layer
+MAX_TILE_ZOOM = 18
+
+# leaflet.heat options the map used: radius 25, blur 15, maxZoom 12
+HEAT_RADIUS = 25
+HEAT_BLUR = 15
+HEAT_MAX_ZOOM = 12
+
+# Pixels a splat reaches beyond its centre, and its Gaussian spread
+KERNEL_RADIUS = HEAT_RADIUS + HEAT_BLUR
+KERNEL_SIGMA = (HEAT_RADIUS + HEAT_BLUR) / 3
+
+# Gradient stops of the map legend, as in L.heatLayer's `gradient` option
+GRADIENT_STOPS = [0.0, 0.2, 0.4, 0.6, 1.0]
+GRADIENT_COLORS = [(0, 0, 255), (0, 0, 255), (0, 255, 0), (255, 255, 0), (255, 0, 0)]
+
+# Point sets (one per filter tuple) and rendered tiles kept in memory
+MAX_POINT_SETS = 8
+MAX_TILES = 1024
+
+
+def _gaussian_kernel():
+    offsets = np.arange(-KERNEL_RADIUS, KERNEL_RADIUS + 1)
+    distance2 = offsets[:, None] ** 2 + offsets[None, :] ** 2
+    kernel = np.exp(-distance2 / (2 * KERNEL_SIGMA ** 2))
+    kernel[distance2 > KERNEL_RADIUS ** 2] = 0
+    return kernel
+
+
+KERNEL = _gaussian_kernel()
+
+# 256-entry RGB palette indexed by heat value
+PALETTE = np.stack(
+    [np.interp(np.linspace(0, 1, 256), GRADIENT_STOPS, [color[i] for color in GRADIENT_COLORS]) for i in range(3)],
+    axis=1,
+).astype(np.uint8)
+
+
+def encode_png(rgba):
+    """Encode an (height, width, 4) uint8 array as an RGBA PNG."""
+    height, width, _ = rgba.shape
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+    # Each scanline starts with filter type 0 (None)
+    scanlines = np.concatenate([np.zeros((height, 1), np.uint8), rgba.reshape(height, width * 4)], axis=1)
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(scanlines.tobytes(), 6))
+        + chunk(b'IEND', b'')
+    )
+
+
+EMPTY_TILE = encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), np.uint8))
+
+
+def project(latitude, longitude):
+    """Web Mercator pixel coordinates at zoom 0 (0..TILE_SIZE on both axes)."""
+    lat = np.radians(np.clip(latitude, -85.0511, 85.0511))
+    x = (longitude + 180.0) / 360.0 * TILE_SIZE
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * TILE_SIZE
+    return x, y
+
+
+class PointSet:
+    """Projected events of one filter tuple at one catalog version."""
+
+    def __init__(self, version, latitude, longitude, magnitude):
+        self.version = version
+        self.x, self.y = project(latitude, longitude)
+        self.magnitude = np.where(np.isnan(magnitude), 1.0, magnitude)
+
+
+_point_sets = OrderedDict()
+_tiles = OrderedDict()
+_tiles_lock = threading.Lock()
+
+
+def get_points(starttime, endtime, minmagnitude, version):
+    key = (starttime, endtime, minmagnitude)
+    with _tiles_lock:
+        points = _point_sets.get(key)
+        if points is not None and points.version == version:
+            _point_sets.move_to_end(key)
+            return points
+    columns = columnar.snapshot().select(starttime, endtime, minmagnitude)
+    points = PointSet(
+        columns.version, columns.latitude.astype(float), columns.longitude.astype(float), columns.magnitude.astype(float)
+    )
+    with _tiles_lock:
+        _point_sets[key] = points
+        while len(_point_sets) > MAX_POINT_SETS:
+            _point_sets.popitem(last=False)
+    return points
+
+
+def is_valid_tile(z, x, y):
+    """Whether z/x/y names a tile of the map, up to MAX_TILE_ZOOM."""
+    return 0 <= z <= MAX_TILE_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def render_tile(points, z, x, y):
+    """Render one heat tile as PNG bytes."""
+    scale = 2 ** z
+    px = points.x * scale - x * TILE_SIZE + KERNEL_RADIUS
+    py = points.y * scale - y * TILE_SIZE + KERNEL_RADIUS
+    size = TILE_SIZE + 2 * KERNEL_RADIUS
+    inside = (px >= 0) & (px < size) & (py >= 0) & (py < size)
+    if not inside.any():
+        return EMPTY_TILE
+
+    zoom_scale = 1.0 / 2 ** max(0, min(HEAT_MAX_ZOOM - z, 12))
+    intensity = np.minimum(points.magnitude[inside] * zoom_scale, 1.0)
+    grid, _, _ = np.histogram2d(
+        py[inside], px[inside], bins=size, range=((0, size), (0, size)), weights=intensity
+    )
+    density = fftconvolve(grid, KERNEL, mode='same')
+    density = density[KERNEL_RADIUS:KERNEL_RADIUS + TILE_SIZE, KERNEL_RADIUS:KERNEL_RADIUS + TILE_SIZE]
+    # Canvas alpha compositing of overlapping splats, 1 - prod(1 - a), for small a
+    value = 1.0 - np.exp(-np.maximum(density, 0))
+
+    rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), np.uint8)
+    rgba[..., :3] = PALETTE[(value * 255).astype(np.uint8)]
+    rgba[..., 3] = (value * 255).astype(np.uint8)
+    return encode_png(rgba)
+
+
+def get_tile(starttime, endtime, minmagnitude, z, x, y):
+    """Return the PNG for a tile, rendered once per catalog version and filters."""
+    version = catalog.get_version()[0]
+    key = (version, starttime, endtime, minmagnitude, z, x, y)
+    with _tiles_lock:
+        tile = _tiles.get(key)
+        if tile is not None:
+            _tiles.move_to_end(key)
+            return tile, version
+    tile = render_tile(get_points(starttime, endtime, minmagnitude, version), z, x, y)
+    with _tiles_lock:
+        _tiles[key] = tile
+        while len(_tiles) > MAX_TILES:
+            _tiles.popitem(last=False)
+    return tile, version
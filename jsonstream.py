@@ -0,0 +1,114 @@
+"""Incremental parsing of one array inside a large JSON document.
+
+FDSN responses are a single object whose "features" array holds every
+event. iter_array() yields the members of such an array as the bytes
+arrive, so only the member being decoded has to be held in memory.
+"""
+import codecs
+import json
+
+import requests
+
+WHITESPACE = ' \t\n\r'
+
+# Characters that can follow the digits decoded so far within one number
+NUMBER_CONTINUES = '.eE+-0123456789'
+
+# Consumed text kept in the buffer before it is cut off
+TRIM_AT = 64 * 1024
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self.buffer = ''
+        self.pos = 0
+
+    def fill(self):
+        """Append the next piece of input; return False at end of input."""
+        if self.pos > TRIM_AT:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        for chunk in self._chunks:
+            text = self._decode(chunk)
+            if text:
+                self.buffer += text
+                return True
+        return False
+
+    def peek(self):
+        """Skip whitespace and return the next character ('' at end of input)."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise requests.exceptions.InvalidJSONError(
+                f"Expected one of {chars!r} at offset {self.pos}, got {char!r}"
+            )
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # A number ending at the buffer end, or cut at its '.', 'e' or
+                # sign (the buffer ends "1." or "1e-"), may not be complete
+                if end < len(self.buffer) and not (
+                    isinstance(value, (int, float)) and self.buffer[end] in NUMBER_CONTINUES
+                ):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                pass
+            if not self.fill():
+                break
+        try:
+            value, self.pos = _decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError as e:
+            raise requests.exceptions.InvalidJSONError(f"Truncated JSON document: {e}")
+        return value
+
+
+def iter_array(chunks, key):
+    """Yield the members of the array stored under `key` in a JSON object.
+
+    `chunks` is an iterable of bytes, such as a streamed response body. The
+    other top-level members are decoded and discarded. An empty body yields
+    nothing; malformed input raises requests.exceptions.InvalidJSONError,
+    as response.json() would.
+    """
+    reader = _Reader(chunks)
+    if not reader.peek():
+        return
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key and reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            reader.value()
+        if reader.expect(',}') == '}':
+            return
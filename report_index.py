@@ -0,0 +1,166 @@
+"""Stored felt reports as NumPy columns, kept in memory by every process.
+
+Reports only ever get appended, so the columns only grow: a refresh asks
+the store for what was written after the last record it read (the log past
+the last offset, or the rows past the last id) and appends those. Reading
+the reports then costs the new records instead of a parse of the whole
+store. A compaction replaces the log and causes one full reload.
+"""
+import threading
+
+import numpy as np
+
+import catalog
+import reports
+
+# Answers on the report form, each from 1 to 5
+SCALES = ('shaking', 'duration', 'objects', 'reactions', 'damage')
+SCALE_LEVELS = 5
+
+COLUMNS = ('id', 'time', 'latitude', 'longitude', 'predicted_magnitude', 'scales')
+
+NAT = np.datetime64('NaT', 'ms').astype(np.int64)
+
+
+def _time(value):
+    try:
+        return np.datetime64(value, 'ms').astype(np.int64)
+    except ValueError:
+        return NAT
+
+
+def _answer(value):
+    """An answer as stored in scales: 0 when missing, SCALE_LEVELS + 1 when out of range."""
+    try:
+        answer = int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+    return answer if 0 <= answer <= SCALE_LEVELS else SCALE_LEVELS + 1
+
+
+def _times(values):
+    """int64 milliseconds since the epoch; NAT for times that don't parse."""
+    try:
+        return np.array(values, dtype='datetime64[ms]').astype(np.int64)
+    except ValueError:
+        # Only when some record is malformed
+        return np.array([_time(value) for value in values], dtype=np.int64)
+
+
+class ReportColumns:
+    """Reports in id order. Never modified in place.
+
+    Unparseable locations are NaN, unparseable times NAT, missing answers
+    0 and out of range ones SCALE_LEVELS + 1. scales has one column per
+    SCALES field.
+    """
+
+    def __init__(self, id, time, latitude, longitude, predicted_magnitude, scales):
+        self.id = id
+        self.time = time
+        self.latitude = latitude
+        self.longitude = longitude
+        self.predicted_magnitude = predicted_magnitude
+        self.scales = scales
+        # Arrays the columns are the start of, with room to extend them
+        self._buffers = None
+
+    @classmethod
+    def from_reports(cls, stored):
+        locations = [reports.parse_location(report.get('location')) for report in stored]
+        return cls(
+            np.array([report.get('id') or 0 for report in stored], dtype=np.int64),
+            # The times are UTC; numpy warns about the Z suffix
+            _times([str(report.get('submission_time') or 'NaT').rstrip('Z') for report in stored]),
+            np.array([latitude for latitude, _ in locations], dtype=float),
+            np.array([longitude for _, longitude in locations], dtype=float),
+            np.array([report.get('predicted_magnitude') for report in stored], dtype=float).astype(np.float32),
+            np.array([[_answer(report.get(scale)) for scale in SCALES] for report in stored], dtype=np.int8).reshape(-1, len(SCALES)),
+        )
+
+    def __len__(self):
+        return len(self.id)
+
+    def extend(self, other):
+        """Return these reports followed by `other`'s.
+
+        The result shares arrays with room to spare with these columns and
+        fills in only the new rows, past the end of what these columns show.
+        Growing the arrays by doubling keeps the copying amortized O(new).
+        """
+        if not len(other):
+            return self
+        size, total = len(self), len(self) + len(other)
+        buffers, self._buffers = self._buffers, None
+        if buffers is None or len(buffers[0]) < total:
+            capacity = max(total, 2 * size, 1024)
+            buffers = []
+            for name in COLUMNS:
+                column = getattr(self, name)
+                buffer = np.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+                buffer[:size] = column
+                buffers.append(buffer)
+        for buffer, name in zip(buffers, COLUMNS):
+            buffer[size:total] = getattr(other, name)
+        columns = ReportColumns(*(buffer[:total] for buffer in buffers))
+        # Only the newest columns may fill the spare room
+        columns._buffers = buffers
+        return columns
+
+    def mask(self, starttime=None, endtime=None, region=None, circle=None):
+        """Reports submitted in [starttime, endtime] inside region and circle."""
+        mask = np.ones(len(self), dtype=bool)
+        if starttime is not None:
+            mask &= self.time >= np.datetime64(starttime, 'ms').astype(np.int64)
+        if endtime is not None:
+            mask &= self.time <= np.datetime64(endtime, 'ms').astype(np.int64)
+        # NAT is the smallest int64: below any starttime, but not above endtime
+        mask &= self.time != NAT
+        if circle is not None:
+            region = catalog.region_around(*circle)
+        if region is not None:
+            # NaN locations fail every comparison
+            mask &= (
+                (self.latitude >= region['minlatitude']) & (self.latitude <= region['maxlatitude'])
+                & (self.longitude >= region['minlongitude']) & (self.longitude <= region['maxlongitude'])
+            )
+        if circle is not None:
+            indexes = np.flatnonzero(mask)
+            distance = catalog.distance_km(circle[0], circle[1], self.latitude[indexes], self.longitude[indexes])
+            mask[indexes[distance > circle[2]]] = False
+        return mask
+
+    def summary(self, mask):
+        """Count, predicted magnitudes and answer histograms of the masked reports."""
+        magnitude = self.predicted_magnitude[mask]
+        magnitude = magnitude[~np.isnan(magnitude)]
+        scales = self.scales[mask].astype(np.int64)
+        return {
+            'count': int(mask.sum()),
+            'predicted_magnitude': {
+                'mean': round(float(magnitude.mean()), 2) if len(magnitude) else None,
+                'max': round(float(magnitude.max()), 2) if len(magnitude) else None,
+            },
+            # Reports per answer, 1 to SCALE_LEVELS; missing and out of range ones are left out
+            'answers': {
+                scale: np.bincount(scales[:, i], minlength=SCALE_LEVELS + 2)[1:SCALE_LEVELS + 1].tolist()
+                for i, scale in enumerate(SCALES)
+            },
+        }
+
+
+_columns = ReportColumns.from_reports([])
+_cursor = None
+_lock = threading.Lock()
+
+
+def snapshot():
+    """Return the stored reports as columns, reading only what is new."""
+    global _columns, _cursor
+    with _lock:
+        stored, cursor, complete = reports.store.read_since(_cursor)
+        new = ReportColumns.from_reports(stored)
+        _columns = new if complete else _columns.extend(new)
+        # Advanced last, so records that failed to load are read again
+        _cursor = cursor
+        return _columns
@@ -0,0 +1,519 @@
+"""Felt reports submitted through /submit_report, behind one storage interface.
+
+JsonReportStore and SqliteReportStore implement ReportStore, and
+REPORT_BACKEND picks the one the app uses.
+
+JsonReportStore keeps an append-only log with one JSON line per report in
+REPORTS_PATH. A submission appends and fsyncs a single line; the next id is
+read from the last line. A report file in the old format (one indented JSON
+array) is converted on first use and left in place as a backup. compact()
+rewrites the log with only its valid, latest records and runs every
+COMPACT_EVERY reports. Queries scan the whole log.
+
+SqliteReportStore keeps reports in an SQLite database in WAL mode, indexed
+on submission_time and on the latitude/longitude parsed from location, so
+inserts and filtered reads don't grow with the number of reports. It
+imports the reports of the JSON store when its table is empty.
+
+The app doesn't write to a store directly. Reports are queued for a
+Committer, a single thread per process that gathers the reports queued
+within FLUSH_INTERVAL and stores them with one append_many(), i.e. one write
+and one fsync or one transaction (group commit). Ids are assigned under the
+store's lock, so they stay unique and increasing across threads and
+processes. append_report() waits for its report to be stored;
+submit_report() returns at once and the report is durable within about
+FLUSH_INTERVAL. The queue holds at most QUEUE_SIZE reports and is flushed
+when the process exits.
+"""
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are serialized between threads only
+    fcntl = None
+
+# "json" or "sqlite"
+REPORT_BACKEND = os.environ.get("REPORT_BACKEND", "json")
+
+REPORTS_PATH = "earthquake_reports.jsonl"
+REPORTS_DB_PATH = "earthquake_reports.db"
+
+# Report file written by earlier versions of the app
+LEGACY_PATH = "earthquake_reports.json"
+
+# Reports appended between two compactions of the log
+COMPACT_EVERY = 10_000
+
+# Bytes read backwards from the end of the log to find the last record
+TAIL_BLOCK = 4096
+
+# Reports stored by one group commit at most
+MAX_BATCH = 256
+
+# Seconds a queued report waits at most before it is written
+FLUSH_INTERVAL = float(os.environ.get("REPORT_FLUSH_INTERVAL", "0.2"))
+
+# Reports queued but not yet written, per process
+QUEUE_SIZE = int(os.environ.get("REPORT_QUEUE_SIZE", "10000"))
+
+# Seconds a submission waits for room in a full queue before it is refused
+QUEUE_TIMEOUT = 2
+
+# Attempts at writing a batch before its reports are given up
+WRITE_ATTEMPTS = 3
+
+
+class QueueFullError(Exception):
+    """Raised when the report queue stays full; retry after retry_after seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+FIELDS = (
+    "location", "shaking", "duration", "objects", "reactions", "damage",
+    "predicted_magnitude", "submission_time",
+)
+
+
+def parse_location(location):
+    """Return (latitude, longitude) from a "lat, lon" string, or (None, None)."""
+    try:
+        latitude, longitude = (float(part) for part in (location or "").split(","))
+    except ValueError:
+        return None, None
+    return latitude, longitude
+
+
+def matches(report, starttime=None, endtime=None, region=None):
+    """Whether a report was submitted in [starttime, endtime] inside region.
+
+    Times are ISO 8601 strings; region has the keys of catalog.BBOX. A report
+    without a parseable location is never inside a region.
+    """
+    submitted = report.get("submission_time") or ""
+    if starttime is not None and submitted < starttime:
+        return False
+    if endtime is not None and submitted > endtime:
+        return False
+    if region is None:
+        return True
+    latitude, longitude = parse_location(report.get("location"))
+    return latitude is not None and (
+        region["minlatitude"] <= latitude <= region["maxlatitude"]
+        and region["minlongitude"] <= longitude <= region["maxlongitude"]
+    )
+
+
+class ReportStore:
+    """Where reports are kept. Stores assign report ids themselves."""
+
+    def append(self, report):
+        """Store a report under the next id and return that id."""
+        return self.append_many([report])[0]
+
+    def append_many(self, reports):
+        """Store reports under the next ids, in one durable write; return the ids."""
+        raise NotImplementedError
+
+    def load(self):
+        """Return every stored report, oldest first."""
+        raise NotImplementedError
+
+    def query(self, starttime=None, endtime=None, region=None):
+        """Return the reports matching matches(), oldest first."""
+        return [report for report in self.load() if matches(report, starttime, endtime, region)]
+
+    def read_since(self, cursor=None):
+        """Return (reports, cursor, complete) for the reports stored after cursor.
+
+        cursor comes from the previous call, or is None to read everything.
+        complete means the reports replace everything read before, rather
+        than follow it.
+        """
+        return self.load(), None, True
+
+    def compact(self):
+        """Reclaim space taken by superseded records, if the store keeps any."""
+
+
+class JsonReportStore(ReportStore):
+    def __init__(self, path=REPORTS_PATH, legacy_path=LEGACY_PATH):
+        self.path = path
+        self.legacy_path = legacy_path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self, file):
+        """Hold the log's lock across threads and worker processes."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _stage(self, reports):
+        """Write one line per report to a new file next to the log; return its path."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, staging = tempfile.mkstemp(prefix=".reports-", dir=directory)
+        with os.fdopen(fd, "w") as file:
+            for report in reports:
+                file.write(json.dumps(report) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        return staging
+
+    def migrate(self):
+        """Convert the legacy JSON array file into the log, once."""
+        if os.path.exists(self.path) or not os.path.exists(self.legacy_path):
+            return
+        with open(self.legacy_path, "r") as file:
+            reports = json.load(file)
+        staging = self._stage(reports)
+        try:
+            # Unlike a rename, linking never replaces a log another worker created
+            os.link(staging, self.path)
+            print(f"Migrated {len(reports)} reports from {self.legacy_path} to {self.path}.")
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(staging)
+
+    @contextmanager
+    def _open_log(self):
+        """Open and lock the log, following it if compaction replaced the file."""
+        self.migrate()
+        while True:
+            with open(self.path, "a+b") as file:
+                with self._locked(file):
+                    if os.fstat(file.fileno()).st_ino == os.stat(self.path).st_ino:
+                        yield file
+                        return
+
+    @staticmethod
+    def _parse(lines):
+        """Decode log lines; a torn last line from an interrupted append is skipped."""
+        reports = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                reports.append(json.loads(line))
+            except ValueError:
+                print(f"Skipping unreadable report record: {line[:80]!r}")
+        return reports
+
+    def load(self):
+        self.migrate()
+        try:
+            with open(self.path, "r") as file:
+                return self._parse(file)
+        except FileNotFoundError:
+            return []
+
+    def read_since(self, cursor=None):
+        """The cursor is the log's inode and the offset read up to.
+
+        Only the bytes past the offset are read. A replaced log (after
+        compaction) or a shorter one is read again from the start.
+        """
+        self.migrate()
+        try:
+            file = open(self.path, "rb")
+        except FileNotFoundError:
+            return [], None, True
+        with file:
+            stat = os.fstat(file.fileno())
+            complete = cursor is None or cursor[0] != stat.st_ino or cursor[1] > stat.st_size
+            offset = 0 if complete else cursor[1]
+            file.seek(offset)
+            tail = file.read()
+        # A line still being appended is read by a later call
+        end = tail.rfind(b"\n") + 1
+        return self._parse(tail[:end].decode().splitlines()), (stat.st_ino, offset + end), complete
+
+    @staticmethod
+    def _last_id(file):
+        """Id of the last complete record, read from the end of the log."""
+        position = file.seek(0, os.SEEK_END)
+        tail = b""
+        while position > 0:
+            step = min(TAIL_BLOCK, position)
+            position -= step
+            file.seek(position)
+            tail = file.read(step) + tail
+            lines = tail.rstrip(b"\n").split(b"\n")
+            # The first piece may be cut off unless the start of the file was reached
+            for line in reversed(lines if position == 0 else lines[1:]):
+                try:
+                    return int(json.loads(line)["id"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return 0
+
+    def append_many(self, reports):
+        """Append one line per report with a single write.
+
+        The lines are fsynced before returning, so acknowledged reports
+        survive a crash.
+        """
+        with self._open_log() as file:
+            first_id = self._last_id(file) + 1
+            report_ids = list(range(first_id, first_id + len(reports)))
+            lines = b"".join(
+                json.dumps({"id": report_id, **report}).encode() + b"\n"
+                for report_id, report in zip(report_ids, reports)
+            )
+            end = file.seek(0, os.SEEK_END)
+            if end:
+                file.seek(end - 1)
+                # Terminate a line torn by an interrupted append instead of extending it
+                if file.read(1) != b"\n":
+                    lines = b"\n" + lines
+            file.write(lines)
+            file.flush()
+            os.fsync(file.fileno())
+        if report_ids and report_ids[-1] // COMPACT_EVERY > (first_id - 1) // COMPACT_EVERY:
+            threading.Thread(target=self.compact, daemon=True).start()
+        return report_ids
+
+    def compact(self):
+        """Rewrite the log keeping the latest valid record for every id."""
+        with self._open_log() as file:
+            file.seek(0)
+            latest = {}
+            for report in self._parse(line.decode() for line in file):
+                latest[report.get("id")] = report
+            staging = self._stage(sorted(latest.values(), key=lambda report: report.get("id") or 0))
+            os.replace(staging, self.path)
+        print(f"Compacted {self.path}: {len(latest)} reports.")
+
+
+class SqliteReportStore(ReportStore):
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS reports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        location TEXT,
+        latitude REAL,
+        longitude REAL,
+        shaking INTEGER,
+        duration INTEGER,
+        objects INTEGER,
+        reactions INTEGER,
+        damage INTEGER,
+        predicted_magnitude REAL,
+        submission_time TEXT
+    );
+    CREATE INDEX IF NOT EXISTS reports_submission_time ON reports (submission_time);
+    CREATE INDEX IF NOT EXISTS reports_location ON reports (latitude, longitude);
+    """
+
+    INSERT = (
+        "INSERT INTO reports (id, location, latitude, longitude, shaking, duration, objects, "
+        "reactions, damage, predicted_magnitude, submission_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+    SELECT = f"SELECT id, {', '.join(FIELDS)} FROM reports"
+
+    def __init__(self, path=REPORTS_DB_PATH, import_from=None):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        if import_from is not None and conn.execute("SELECT COUNT(*) FROM reports").fetchone()[0] == 0:
+            reports = import_from.load()
+            # Ids are kept, and the import is one transaction
+            with conn:
+                conn.executemany(self.INSERT, (self._row(report, report.get("id")) for report in reports))
+            if reports:
+                print(f"Imported {len(reports)} reports into {path}.")
+
+    def _connection(self):
+        """This thread's connection; sqlite3 caches its prepared statements."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+        return conn
+
+    @staticmethod
+    def _row(report, report_id=None):
+        latitude, longitude = parse_location(report.get("location"))
+        return (report_id, report.get("location"), latitude, longitude) + tuple(
+            report.get(field) for field in FIELDS[1:]
+        )
+
+    @staticmethod
+    def _report(row):
+        return {"id": row["id"], **{field: row[field] for field in FIELDS}}
+
+    def append_many(self, reports):
+        conn = self._connection()
+        # One transaction, so one sync of the WAL for the whole batch
+        with conn:
+            return [conn.execute(self.INSERT, self._row(report)).lastrowid for report in reports]
+
+    def load(self):
+        rows = self._connection().execute(self.SELECT + " ORDER BY id")
+        return [self._report(row) for row in rows]
+
+    def read_since(self, cursor=None):
+        """The cursor is the last id read; ids only grow."""
+        rows = self._connection().execute(self.SELECT + " WHERE id > ? ORDER BY id", (cursor or 0,))
+        reports = [self._report(row) for row in rows]
+        return reports, reports[-1]["id"] if reports else cursor, cursor is None
+
+    def query(self, starttime=None, endtime=None, region=None):
+        clauses, params = [], []
+        if starttime is not None:
+            clauses.append("submission_time >= ?")
+            params.append(starttime)
+        if endtime is not None:
+            clauses.append("submission_time <= ?")
+            params.append(endtime)
+        if region is not None:
+            clauses.append("latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?")
+            params += [region["minlatitude"], region["maxlatitude"], region["minlongitude"], region["maxlongitude"]]
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._connection().execute(self.SELECT + where + " ORDER BY id", params)
+        return [self._report(row) for row in rows]
+
+
+class Committer:
+    """The single writer of a store within the process.
+
+    Submitters queue their report and get a future. The committer thread
+    takes what is queued within flush_interval of the first report, up to
+    max_batch reports, and stores it with one append_many(), so concurrent
+    submissions share a write. A report submitted with wait=True has a
+    caller blocked on it, so it is written without waiting out the
+    interval. When the queue is full, submit() waits up to QUEUE_TIMEOUT for
+    room and then raises QueueFullError.
+    """
+
+    def __init__(self, store, max_batch=MAX_BATCH, flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE):
+        self.store = store
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, report, wait=False):
+        """Queue a report; the future resolves to its id once it is stored."""
+        future = Future()
+        self._start()
+        try:
+            self._queue.put((report, future, wait), timeout=QUEUE_TIMEOUT)
+        except queue.Full:
+            raise QueueFullError(f"{self._queue.maxsize} reports are waiting to be written", self.flush_interval)
+        return future
+
+    def close(self):
+        """Write every queued report, then stop the committer thread."""
+        with self._start_lock:
+            thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(None)
+        thread.join()
+
+    def _start(self):
+        # Started on first use, and again in a forked worker where it isn't running
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="report-committer", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        """Queued reports and whether close() asked the thread to stop."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        waiting = batch[0] is not None and batch[0][2]
+        while len(batch) < self.max_batch and batch[-1] is not None:
+            try:
+                # Once a caller is waiting, only what is already queued joins the batch
+                item = self._queue.get(timeout=0 if waiting else max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            batch.append(item)
+            waiting = waiting or (item is not None and item[2])
+        if batch[-1] is None:
+            return batch[:-1], True
+        return batch, False
+
+    def _write(self, batch):
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                report_ids = self.store.append_many([report for report, _, _ in batch])
+            except Exception as e:
+                print(f"Error storing {len(batch)} reports (attempt {attempt}): {e}")
+                error = e
+                time.sleep(self.flush_interval)
+                continue
+            for (_, future, _), report_id in zip(batch, report_ids):
+                future.set_result(report_id)
+            return
+        print(f"Dropped {len(batch)} reports that could not be stored.")
+        for _, future, _ in batch:
+            future.set_exception(error)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._write(batch)
+
+
+def open_store(backend=REPORT_BACKEND):
+    """Return the report store for a backend name."""
+    if backend == "json":
+        return JsonReportStore()
+    if backend == "sqlite":
+        return SqliteReportStore(import_from=JsonReportStore())
+    raise ValueError(f"Unknown report backend: {backend!r}")
+
+
+store = open_store()
+committer = Committer(store)
+# Runs before the interpreter stops daemon threads, so queued reports are kept
+atexit.register(committer.close)
+
+
+def load_reports():
+    """Return every stored report, oldest first."""
+    return store.load()
+
+
+def append_report(report):
+    """Store a report under the next id and return that id, once it is durable."""
+    return committer.submit(report, wait=True).result()
+
+
+def submit_report(report):
+    """Queue a report for writing without waiting; may raise QueueFullError."""
+    return committer.submit(report)
+
+
+def query_reports(starttime=None, endtime=None, region=None):
+    """Return the reports submitted in [starttime, endtime] inside region."""
+    return store.query(starttime, endtime, region)
+
+
+def compact():
+    store.compact()
@@ -0,0 +1,406 @@
+"""Shared HTTP client for calls to the FDSN service.
+
+All upstream requests go through one pooled keep-alive session, so repeated
+calls reuse TCP/TLS connections, and every call is bounded by connect/read
+timeouts plus an overall deadline so a stalled upstream can't hang a worker.
+A circuit breaker stops calling an upstream that keeps failing or is slow,
+and a token bucket shared by all worker processes keeps the request rate,
+and any Retry-After pause the provider asks for, common to every caller.
+"""
+import mmap
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import fcntl
+except ImportError:  # Windows: the bucket is shared between threads only
+    fcntl = None
+
+USER_AGENT = 'MyFlaskApp/1.0'
+
+# Seconds to establish a connection / to wait between bytes
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# Upper bound in seconds on the time spent waiting for upstream in one
+# request, body download included; the caller's work on the body isn't counted
+DEADLINE = 60
+
+# Connections kept open per upstream host
+POOL_SIZE = 16
+
+CHUNK_SIZE = 64 * 1024
+
+# Consecutive failures (or responses slower than LATENCY_BUDGET seconds)
+# that open the circuit, and seconds before a probe request is let through
+FAILURE_THRESHOLD = 5
+LATENCY_BUDGET = 10
+RESET_TIMEOUT = 30
+
+# Sustained upstream requests per second and the burst allowed on top
+RATE_LIMIT = 2
+RATE_BURST = 10
+
+# File holding the token bucket state shared by all worker processes
+RATE_LIMIT_PATH = os.path.join(tempfile.gettempdir(), "earthquake-geoapp-fdsn.bucket")
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of calling an upstream the breaker has given up on."""
+
+
+class RateLimitedError(requests.exceptions.RequestException):
+    """Raised instead of calling upstream while no request token is available."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket whose state lives in a memory-mapped file.
+
+    Every process mapping the same file shares one bucket; an flock around
+    each update keeps them consistent. A pause (from a 429 Retry-After)
+    empties the bucket for everyone until it runs out.
+    """
+
+    # tokens, last refill time, paused until (wall-clock seconds)
+    STATE = struct.Struct('<ddd')
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, path=RATE_LIMIT_PATH):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._file = None
+        if fcntl is not None and path is not None:
+            self._file = open(path, 'a+b')
+            with self._locked():
+                created = os.fstat(self._file.fileno()).st_size < self.STATE.size
+                if created:
+                    self._file.truncate(self.STATE.size)
+                self._state = mmap.mmap(self._file.fileno(), self.STATE.size)
+                if created:
+                    self._write(burst, time.time(), 0.0)
+        else:
+            self._state = bytearray(self.STATE.size)
+            self._write(burst, time.time(), 0.0)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if self._file is None:
+                yield
+                return
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _read(self):
+        return self.STATE.unpack_from(self._state)
+
+    def _write(self, tokens, updated, paused_until):
+        self.STATE.pack_into(self._state, 0, tokens, updated, paused_until)
+
+    def try_acquire(self):
+        """Take a token if one is available; return 0, or seconds to wait."""
+        with self._locked():
+            tokens, updated, paused_until = self._read()
+            now = time.time()
+            if now < paused_until:
+                return paused_until - now
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._write(tokens, now, paused_until)
+                return (1 - tokens) / self.rate
+            self._write(tokens - 1, now, paused_until)
+            return 0
+
+    def acquire(self, max_wait=0):
+        """Take a token, waiting at most max_wait seconds for one.
+
+        Request threads use max_wait=0 so they fail fast instead of sleeping;
+        RateLimitedError carries how long until a token is expected.
+        """
+        give_up_at = time.monotonic() + max_wait
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            if time.monotonic() + wait > give_up_at:
+                raise RateLimitedError(f"Upstream rate limited for {wait:.1f}s", wait)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens to every caller for `seconds`."""
+        until = time.time() + seconds
+        with self._locked():
+            _, _, paused_until = self._read()
+            # Refill restarts when the pause ends
+            self._write(0, until, max(paused_until, until))
+
+
+def parse_retry_after(value, default=2):
+    """Seconds from a Retry-After header given as delay or HTTP date."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None
+
+    def allow(self):
+        """Return True if a request may go upstream now.
+
+        Once reset_timeout has passed on an open circuit a single probe is
+        allowed; its outcome closes or re-opens the circuit.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def release_probe(self):
+        """End a probe that failed for a local reason, so another is allowed."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"Upstream circuit opened after {self.failures} failures.")
+                self.opened_at = time.monotonic()
+
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'User-Agent': USER_AGENT,
+        'Accept-Encoding': 'gzip, deflate',
+        'Accept': 'application/json',
+    })
+    return session
+
+
+# urllib3's connection pool is thread-safe; the session itself keeps no
+# per-request state we rely on, so all worker threads share it.
+session = create_session()
+breaker = CircuitBreaker()
+limiter = TokenBucket()
+
+
+def get(url, deadline=DEADLINE, max_wait=0, **kwargs):
+    """GET `url` through the shared session within `deadline` seconds.
+
+    The body is read in chunks so the deadline also covers slow downloads;
+    requests.exceptions.Timeout is raised when it runs out. While the
+    circuit breaker is open CircuitOpenError is raised without a request.
+
+    Each call takes a token from the shared rate limiter, waiting at most
+    max_wait seconds. A 429 pauses the limiter for every caller for its
+    Retry-After and raises RateLimitedError.
+    """
+    with open_stream(url, deadline, max_wait, **kwargs) as (response, body):
+        response._content = b''.join(body)
+    return response
+
+
+@contextmanager
+def open_stream(url, deadline=DEADLINE, max_wait=0, **kwargs):
+    """Like get(), but yield (response, body) with the body as an iterator.
+
+    The decompressed body arrives in CHUNK_SIZE pieces as it is read from
+    the socket, so callers can parse it without holding all of it. Only the
+    reads count against the deadline and LATENCY_BUDGET, not what the caller
+    does between them. Connection errors, timeouts, 5xx responses and
+    responses over LATENCY_BUDGET count as failures for the circuit breaker;
+    4xx responses mean upstream answered. An exception from the caller's own
+    work is no verdict on upstream: it releases a probe of the circuit
+    breaker but counts as neither success nor failure.
+    """
+    limiter.acquire(max_wait)
+    if not breaker.allow():
+        raise CircuitOpenError(f"Upstream circuit is open, not fetching {url}")
+
+    started = time.monotonic()
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    try:
+        response = session.get(url, stream=True, **kwargs)
+    except requests.exceptions.RequestException:
+        breaker.record_failure()
+        raise
+
+    body = Body(response, url, deadline, time.monotonic() - started)
+    try:
+        if response.status_code == 429:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            print(f"Rate limited. Pausing upstream calls for {retry_after} seconds...")
+            limiter.pause(retry_after)
+            # The upstream answered, it is just asking us to slow down
+            breaker.record_success()
+            raise RateLimitedError(f"Upstream asked to retry after {retry_after}s", retry_after)
+
+        try:
+            yield response, body
+        except requests.exceptions.HTTPError:
+            # The caller's raise_for_status(): upstream did answer, and only a
+            # server error counts against it, not a request it rejected (4xx)
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        except requests.exceptions.RequestException:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.release_probe()
+            raise
+        if response.status_code >= 500 or body.elapsed > LATENCY_BUDGET:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    finally:
+        response.close()
+
+
+class Body:
+    """Iterator over a response body in chunks that times only the reads.
+
+    elapsed starts at the time the response headers took and adds up the
+    time spent waiting for each chunk. The deadline is a hard limit: one
+    chunk read can take long when upstream trickles bytes just inside the
+    read timeout, so a timer shuts the connection's socket down once the
+    time left runs out, and the read ends in requests.exceptions.Timeout.
+    """
+
+    def __init__(self, response, url, deadline, elapsed):
+        self._response = response
+        self._chunks = response.iter_content(CHUNK_SIZE)
+        self._expired = threading.Event()
+        self.url = url
+        self.deadline = deadline
+        self.elapsed = elapsed
+
+    def __iter__(self):
+        return self
+
+    def _timeout(self):
+        return requests.exceptions.Timeout(f"Upstream request exceeded its deadline: {self.url}")
+
+    def _cut_off(self):
+        self._expired.set()
+        sock = getattr(getattr(self._response.raw, 'connection', None), 'sock', None)
+        if sock is None:
+            # Once upstream said it will close the connection, http.client
+            # drops it and only the response's file still has the socket
+            reader = getattr(getattr(self._response.raw, '_fp', None), 'fp', None)
+            sock = getattr(getattr(reader, 'raw', None), '_sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __next__(self):
+        if self._expired.is_set() or self.elapsed > self.deadline:
+            raise self._timeout()
+        timer = threading.Timer(self.deadline - self.elapsed, self._cut_off)
+        timer.daemon = True
+        started = time.monotonic()
+        timer.start()
+        try:
+            chunk = next(self._chunks)
+        except (StopIteration, OSError, requests.exceptions.RequestException):
+            # A body read until the connection closes looks complete once cut off
+            if self._expired.is_set():
+                raise self._timeout() from None
+            raise
+        finally:
+            timer.cancel()
+            self.elapsed += time.monotonic() - started
+        if self.elapsed > self.deadline:
+            raise self._timeout()
+        return chunk
+
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into one execution.
+
+    The first caller for a key runs the function; callers arriving while it
+    is still running wait for and share its result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]